@@ -1,27 +1,47 @@
 import sys
-import sqlite3
+import threading
+import time
+# Startup timing counts from here, before the Qt imports
+_IMPORT_STARTED = time.perf_counter()
+import uuid
+# uuid.getnode() may run helper programs to find the MAC address; it runs on
+# a thread of its own while Qt is imported instead of after
+_machine_node = []
+_machine_node_lookup = threading.Thread(target=lambda: _machine_node.append(uuid.getnode()),
+                                        name='machine-id', daemon=True)
+_machine_node_lookup.start()
 from datetime import datetime
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                             QHBoxLayout, QPushButton, QLabel, QLineEdit,
                             QTableWidget, QTableWidgetItem, QMessageBox,
                             QTabWidget, QSpinBox, QDoubleSpinBox, QGridLayout,
-                            QScrollArea, QFrame, QFileDialog, QDialog)
-from PyQt6.QtCore import Qt
-from PyQt6.QtGui import QPixmap, QIcon
-from PyQt6.QtPrintSupport import QPrinter, QPrintDialog
+                            QScrollArea, QFrame, QFileDialog, QDialog,
+                            QTableView, QStyledItemDelegate, QStyle, QDateEdit)
+from PyQt6.QtCore import (Qt, QBuffer, QIODevice, QAbstractTableModel, QModelIndex,
+                          QEvent, QRectF, QObject, QThreadPool, QTimer, QDate, pyqtSignal)
+from PyQt6.QtGui import QPixmap, QIcon, QImage, QColor, QPen
 from PyQt6.QtGui import QTextDocument
 
-import base64
-from contextlib import contextmanager
+from collections import OrderedDict
+from functools import partial
+from html import escape
+
+from bakery_core import (to_cents, format_money, format_lbp, CartLine, Cart, InvoiceSearch,
+                         CELL_THUMBNAIL, BUTTON_THUMBNAIL, THUMBNAIL_SIZES, DatabaseManager,
+                         QueryProfile, InventoryService, SalesService, InvoicingService,
+                         ReportingService, BackupManager)
+from bakery_server import (BakeryClient, RemoteDatabase, RemoteInventory, RemoteSales, RemoteInvoicing,
+                           RemoteReporting, ReplicaInventory, SyncAgent)
 
 
-import uuid
 from PyQt6.QtWidgets import QMessageBox
 
 AUTHORIZED_ID = "841b77f4b67b"  # Your authorized machine ID
 
 def get_machine_id():
-    return f"{uuid.getnode():012x}"
+    # Looked up since the module started importing
+    _machine_node_lookup.join()
+    return f"{_machine_node[0]:012x}"
 
 def enforce_license():
     if get_machine_id() != AUTHORIZED_ID:
@@ -29,61 +49,185 @@ def enforce_license():
         sys.exit()
 
 
-class DatabaseManager:
-    """Centralized database management"""
-    def __init__(self, db_name='bakery.db'):
-        self.db_name = db_name
-        self._init_db()
+def render_thumbnails(image_data):
+    """Scale encoded image bytes to every thumbnail size, returned as PNG bytes"""
+    image = QImage.fromData(image_data)
+    if image.isNull():
+        raise ValueError("Unsupported image file")
     
-    @contextmanager
-    def get_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_name)
-        try:
-            yield conn
-        finally:
-            conn.close()
+    thumbnails = {}
+    for width, height in THUMBNAIL_SIZES:
+        scaled = image.scaled(width, height, Qt.AspectRatioMode.KeepAspectRatio,
+                              Qt.TransformationMode.SmoothTransformation)
+        buffer = QBuffer()
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        scaled.save(buffer, 'PNG')
+        thumbnails[(width, height)] = bytes(buffer.data())
+    return thumbnails
+
+def thumbnail_data(db, image_hash, size):
+    """Load a stored thumbnail's PNG bytes, rendering it from the original if
+    it is missing. Runs on a QueryRunner thread; only the GUI thread may turn
+    the bytes into a QPixmap."""
+    data = db.get_thumbnail(image_hash, size)
+    if data is None:
+        original = db.get_image(image_hash)
+        if original is None:
+            return None
+        thumbnails = render_thumbnails(original)
+        db.store_image(original, thumbnails)
+        data = thumbnails[size]
+    return data
+
+
+class PixmapCache:
+    """Bounded LRU cache of decoded thumbnails shared by every view.
+
+    Entries are keyed by (item_id, image_hash, size). The hash is the image
+    version: editing an item's image changes it, and invalidate() drops the
+    item's old entries right away instead of waiting for them to age out.
     
-    def _init_db(self):
-        """Initialize database tables"""
-        with self.get_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS items (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    price REAL NOT NULL,
-                    image_data TEXT
-                )
-            ''')
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sales (
-                    id INTEGER PRIMARY KEY,
-                    item_id INTEGER,
-                    quantity INTEGER,
-                    total_price REAL,
-                    sale_date DATETIME,
-                    FOREIGN KEY (item_id) REFERENCES items (id)
-                )
-            ''')
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS daily_invoice_count (
-                    date TEXT PRIMARY KEY,
-                    count INTEGER DEFAULT 0
-                )
-            ''')
-            
-            conn.commit()
+    A thumbnail that is not cached is read on the runner's threads, never on
+    the GUI thread, and handed to the callers waiting for it once decoded.
+    """
+    def __init__(self, db, runner, max_bytes=64 * 1024 * 1024):
+        self.db = db
+        self.runner = runner
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # Callbacks waiting for each thumbnail being read
+        self._waiting = {}
+    
+    def pixmap(self, item_id, image_hash, size, on_loaded=None):
+        """Decoded thumbnail for an item if it is cached. Otherwise None, and
+        on_loaded(pixmap) is called once it has been read; pixmap is None if
+        the item has no usable image."""
+        entry = self._entry(item_id, image_hash, size, on_loaded)
+        return entry[0] if entry else None
+    
+    def icon(self, item_id, image_hash, size):
+        """The cached thumbnail as a QIcon, or None if it is not cached"""
+        entry = self._entry(item_id, image_hash, size)
+        if not entry:
+            return None
+        if entry[1] is None:
+            entry[1] = QIcon(entry[0])
+        return entry[1]
+    
+    def _entry(self, item_id, image_hash, size, on_loaded=None):
+        key = (item_id, image_hash, size)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        
+        waiting = self._waiting.get(key)
+        if waiting is None:
+            self.misses += 1
+            waiting = self._waiting[key] = []
+            self.runner.submit(None, thumbnail_data, self.db, image_hash, size,
+                               on_result=partial(self._loaded, key),
+                               on_error=lambda error: self._loaded(key, None))
+        if on_loaded is not None:
+            waiting.append(on_loaded)
+        return None
+    
+    def _loaded(self, key, data):
+        callbacks = self._waiting.pop(key, None)
+        if callbacks is None:
+            # Invalidated while it was being read
+            return
+        pixmap = None
+        if data is not None:
+            pixmap = QPixmap()
+            pixmap.loadFromData(data)
+        if pixmap is None or pixmap.isNull():
+            pixmap = None
+        else:
+            self._entries[key] = [pixmap, None]
+            self._bytes += self._cost(pixmap)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= self._cost(evicted)
+        for callback in callbacks:
+            try:
+                callback(pixmap)
+            except RuntimeError:
+                # The widget that asked for it has been deleted since
+                pass
+    
+    @staticmethod
+    def _cost(pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+    
+    def invalidate(self, item_id):
+        """Forget every cached size of an item's image"""
+        for key in [key for key in self._entries if key[0] == item_id]:
+            self._bytes -= self._cost(self._entries.pop(key)[0])
+        for key in [key for key in self._waiting if key[0] == item_id]:
+            del self._waiting[key]
+    
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'loading': len(self._waiting),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class StartupTimer:
+    """Milliseconds spent in each step of startup, counted from the moment
+    this module started importing"""
+    def __init__(self, started=_IMPORT_STARTED, echo=False):
+        self.started = started
+        self.echo = echo
+        self.steps = []
+        self.done = False
+        self._last = started
+    
+    def mark(self, step):
+        """Close the step that ran since the previous mark"""
+        if self.done:
+            return
+        now = time.perf_counter()
+        self.steps.append((step, (now - self._last) * 1000))
+        self._last = now
+    
+    def finish(self, step):
+        """Close the last step; prints the breakdown when echo is on"""
+        if self.done:
+            return
+        self.mark(step)
+        self.done = True
+        if self.echo:
+            print(self.report())
+    
+    def summary(self):
+        return {
+            'steps_ms': {step: round(ms, 1) for step, ms in self.steps},
+            'total_ms': round((self._last - self.started) * 1000, 1),
+        }
+    
+    def report(self):
+        lines = [f"  {step:<12} {ms:8.1f} ms" for step, ms in self.steps]
+        lines.append(f"  {'total':<12} {(self._last - self.started) * 1000:8.1f} ms")
+        return "Startup:\n" + "\n".join(lines)
+
 
 class EditItemDialog(QDialog):
-    def __init__(self, parent=None, item_data=None):
+    def __init__(self, parent=None, item_data=None, pixmap_cache=None):
         super().__init__(parent)
         self.setWindowTitle("Edit Item")
         self.setModal(True)
         self.item_data = item_data
+        self.pixmap_cache = pixmap_cache
         self.image_path = None
         self._setup_ui()
     
@@ -114,13 +258,8 @@ class EditItemDialog(QDialog):
         self.image_preview.setStyleSheet("border: 1px solid #ccc;")
         
         if self.item_data[3]:
-            try:
-                image_data = base64.b64decode(self.item_data[3])
-                pixmap = QPixmap()
-                pixmap.loadFromData(image_data)
-                self.image_preview.setPixmap(pixmap.scaled(50, 50, Qt.AspectRatioMode.KeepAspectRatio))
-            except:
-                pass
+            self._show_current_image(self.pixmap_cache.pixmap(
+                self.item_data[0], self.item_data[3], CELL_THUMBNAIL, on_loaded=self._show_current_image))
         
         select_image_btn = QPushButton("Change Image")
         select_image_btn.clicked.connect(self.select_image)
@@ -152,25 +291,438 @@ class EditItemDialog(QDialog):
             pixmap = QPixmap(file_name)
             self.image_preview.setPixmap(pixmap.scaled(50, 50, Qt.AspectRatioMode.KeepAspectRatio))
     
+    def _show_current_image(self, pixmap):
+        # Unless another image has been chosen while it loaded
+        if pixmap and not self.image_path:
+            self.image_preview.setPixmap(pixmap)
+    
     def get_updated_data(self):
-        image_data = self.item_data[3]  # Keep existing image by default
-        if self.image_path:
-            with open(self.image_path, 'rb') as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
-        
+        # The new image, if any, is read and stored off the GUI thread
         return {
             'name': self.name_edit.text(),
             'price': self.price_edit.value(),
-            'image_data': image_data
+            'image_path': self.image_path
         }
 
+class _TaskSignals(QObject):
+    done = pyqtSignal(object, object)
+
+
+class _QueryTask:
+    """One database call waiting for or running on a QueryRunner thread"""
+    def __init__(self, db, fn, args, caller=None):
+        self.db = db
+        self.fn = fn
+        self.args = args
+        self.caller = caller
+        self.cancelled = False
+        self.connection = None
+        self.signals = _TaskSignals()
+        # Guards connection, so cancel() only interrupts the pool thread's
+        # connection while this task is the one using it
+        self._lock = threading.Lock()
+    
+    def run(self):
+        with self._lock:
+            cancelled = self.cancelled
+        if cancelled:
+            self.signals.done.emit(None, None)
+            return
+        result = error = None
+        try:
+            with self.db.get_connection() as conn:
+                with self._lock:
+                    if self.cancelled:
+                        raise InterruptedError("Cancelled")
+                    self.connection = conn
+                profile = self.db.profile
+                if self.caller is not None and profile is not None:
+                    with profile.calling(self.caller):
+                        result = self.fn(*self.args)
+                else:
+                    result = self.fn(*self.args)
+        except Exception as e:
+            error = e
+        finally:
+            with self._lock:
+                self.connection = None
+        self.signals.done.emit(result, error)
+    
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self.connection is not None:
+                # Abort the statement in progress; a no-op if it already finished
+                self.connection.interrupt()
+
+
+class QueryRunner(QObject):
+    """Runs database calls on worker threads and hands results back on the
+    GUI thread, so a slow disk or a big report never blocks the event loop.
+
+    Requests submitted under the same key supersede each other: a newer
+    history refresh cancels the older one, and a superseded result is never
+    delivered. Pass key=None for calls that must run to completion, such as
+    a checkout.
+    """
+    def __init__(self, db, parent=None, max_threads=2):
+        super().__init__(parent)
+        self.db = db
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        # Worker threads keep their database connection for the app's lifetime
+        self.pool.setExpiryTimeout(-1)
+        self._tasks = set()
+        self._latest = {}
+    
+    def submit(self, key, fn, *args, on_result=None, on_error=None):
+        if key is not None:
+            self.cancel(key)
+        caller = None
+        if self.db.profile is not None:
+            # The worker thread's stack no longer shows who asked
+            caller = QueryProfile.caller_name(sys._getframe(1))
+        task = _QueryTask(self.db, fn, args, caller)
+        if key is not None:
+            self._latest[key] = task
+        self._tasks.add(task)
+        task.signals.done.connect(
+            lambda result, error: self._deliver(key, task, result, error, on_result, on_error))
+        self.pool.start(task.run)
+        return task
+    
+    def _deliver(self, key, task, result, error, on_result, on_error):
+        self._tasks.discard(task)
+        if key is not None and self._latest.get(key) is task:
+            del self._latest[key]
+        if task.cancelled:
+            return
+        if error is not None:
+            if on_error:
+                on_error(error)
+        elif on_result:
+            on_result(result)
+    
+    def cancel(self, key):
+        task = self._latest.pop(key, None)
+        if task is not None:
+            task.cancel()
+    
+    def shutdown(self):
+        for key in list(self._latest):
+            self.cancel(key)
+        self.pool.waitForDone()
+
+
+class InvoiceHistoryModel(QAbstractTableModel):
+    """Invoice history read from SQL one page at a time as the view scrolls.
+
+    Rows are kept as typed tuples (id, number, created_at, total_quantity,
+    total); nothing is formatted until the view asks for it. Sorting asks
+    the database for the history in the new order and starts paging again.
+    """
+    HEADERS = ["Invoice #", "Date", "Items Count", "Total", "Details"]
+    DETAILS_COLUMN = 4
+    # View column -> (invoices column, position in a row tuple)
+    SORT_KEYS = {0: ('number', 1), 1: ('created_at', 2), 2: ('total_quantity', 3), 3: ('total', 4)}
+    PAGE_SIZE = 200
+    
+    load_failed = pyqtSignal(str)
+    
+    def __init__(self, invoicing, runner, parent=None):
+        super().__init__(parent)
+        self.invoicing = invoicing
+        self.runner = runner
+        self.rows = []
+        self.since = datetime.min
+        self.search = None
+        self.sort_column = 1
+        self.descending = True
+        self._exhausted = True
+        self._fetching = False
+    
+    def reload(self, since, search=None):
+        """Drop loaded rows and start again from the first invoice after
+        since, or from the first match of an InvoiceSearch"""
+        self.runner.cancel('history')
+        self.beginResetModel()
+        self.rows = []
+        self.since = since
+        self.search = search
+        self._exhausted = False
+        self._fetching = False
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+    
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if orientation == Qt.Orientation.Horizontal and role == Qt.ItemDataRole.DisplayRole:
+            return self.HEADERS[section]
+        return None
+    
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.ItemDataRole.UserRole:
+            return row[0]
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        
+        column = index.column()
+        if column == 0:
+            return f"INV-{row[1]:04d}"
+        if column == 1:
+            return row[2].strftime('%Y-%m-%d %H:%M')
+        if column == 2:
+            return str(row[3])
+        if column == 3:
+            return f"${row[4]:.2f}"
+        return "View Details"
+    
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._exhausted and not self._fetching
+    
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        order_by, key_index = self.SORT_KEYS[self.sort_column]
+        after = None
+        if self.rows:
+            last = self.rows[-1]
+            after = (last[key_index], last[0])
+        
+        self._fetching = True
+        self.runner.submit('history', self._read_page, self.since, after, order_by, self.descending,
+                           self.search, on_result=self._append_page, on_error=self._page_failed)
+    
+    def _read_page(self, since, after, order_by, descending, search):
+        # Runs on a worker thread
+        page = self.invoicing.page(since, after, self.PAGE_SIZE, order_by, descending, search)
+        return [(row[0], row[1], datetime.fromisoformat(row[2]), row[3], row[4]) for row in page]
+    
+    def _append_page(self, page):
+        self._fetching = False
+        self._exhausted = len(page) < self.PAGE_SIZE
+        if not page:
+            return
+        start = len(self.rows)
+        self.beginInsertRows(QModelIndex(), start, start + len(page) - 1)
+        self.rows.extend(page)
+        self.endInsertRows()
+    
+    def _page_failed(self, error):
+        self._fetching = False
+        self.load_failed.emit(str(error))
+    
+    def sort(self, column, order=Qt.SortOrder.AscendingOrder):
+        descending = order == Qt.SortOrder.DescendingOrder
+        if column not in self.SORT_KEYS or (column, descending) == (self.sort_column, self.descending):
+            return
+        self.sort_column = column
+        self.descending = descending
+        self.reload(self.since, self.search)
+
+
+class ViewDetailsDelegate(QStyledItemDelegate):
+    """Paints a "View Details" button in each cell and reports clicks,
+    instead of the view owning a real QPushButton per row"""
+    clicked = pyqtSignal(int)
+    
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setRenderHint(painter.RenderHint.Antialiasing)
+        rect = QRectF(option.rect).adjusted(3, 3, -3, -3)
+        hovered = bool(option.state & QStyle.StateFlag.State_MouseOver)
+        painter.setPen(QPen(QColor("#2196f3")))
+        painter.setBrush(QColor("#bbdefb" if hovered else "#e3f2fd"))
+        painter.drawRoundedRect(rect, 3, 3)
+        font = painter.font()
+        font.setPixelSize(11)
+        painter.setFont(font)
+        painter.setPen(QColor("#1976d2"))
+        painter.drawText(rect, Qt.AlignmentFlag.AlignCenter, index.data())
+        painter.restore()
+    
+    def editorEvent(self, event, model, option, index):
+        if (event.type() == QEvent.Type.MouseButtonRelease
+                and event.button() == Qt.MouseButton.LeftButton
+                and option.rect.contains(event.position().toPoint())):
+            self.clicked.emit(index.data(Qt.ItemDataRole.UserRole))
+            return True
+        return False
+
+
+class ItemButton(QWidget):
+    """Product tile in the sales grid, updated in place when its item changes"""
+    WIDTH = 120
+    HEIGHT = 100
+    
+    def __init__(self, item, pixmap_cache, on_click):
+        super().__init__()
+        self.item = None
+        self.pixmap_cache = pixmap_cache
+        self.grid_position = None
+        self.setFixedSize(self.WIDTH, self.HEIGHT + 40)
+        
+        layout = QVBoxLayout(self)
+        layout.setSpacing(2)
+        layout.setContentsMargins(2, 2, 2, 2)
+        
+        self.button = QPushButton()
+        self.button.setObjectName("itemButton")
+        self.button.setFixedSize(self.WIDTH - 4, self.HEIGHT - 4)
+        self.button.clicked.connect(lambda checked: on_click(*self.item[:3]))
+        
+        self.name_label = QLabel()
+        self.name_label.setObjectName("itemName")
+        self.name_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        self.name_label.setWordWrap(True)
+        
+        self.price_label = QLabel()
+        self.price_label.setObjectName("itemPrice")
+        self.price_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
+        
+        layout.addWidget(self.button)
+        layout.addWidget(self.name_label)
+        layout.addWidget(self.price_label)
+        
+        self.set_item(item)
+    
+    def set_item(self, item):
+        """Apply an (id, name, price, image_hash) row, updating only what changed"""
+        old = self.item or (None, None, None, None)
+        self.item = item
+        if item[1] != old[1]:
+            self.name_label.setText(item[1])
+        if item[2] != old[2]:
+            self.price_label.setText(f"${item[2]:.2f}")
+        if item[3] != old[3]:
+            self._set_icon(item)
+    
+    def _set_icon(self, item):
+        pixmap = None
+        if item[3]:
+            pixmap = self.pixmap_cache.pixmap(item[0], item[3], BUTTON_THUMBNAIL,
+                                              on_loaded=partial(self._icon_loaded, item))
+        self._show_icon(item, pixmap)
+    
+    def _icon_loaded(self, item, pixmap):
+        # The tile may show another item or image by the time it arrives
+        if self.item[0] == item[0] and self.item[3] == item[3]:
+            self._show_icon(item, pixmap)
+    
+    def _show_icon(self, item, pixmap):
+        if pixmap:
+            self.button.setIcon(self.pixmap_cache.icon(item[0], item[3], BUTTON_THUMBNAIL))
+            self.button.setIconSize(pixmap.size())
+        else:
+            self.button.setIcon(QIcon())
+
 class BakeryApp(QMainWindow):
-    def __init__(self):
+    ITEM_GRID_COLUMNS = 4
+    ITEM_TILE_BATCH = 24
+    
+    def __init__(self, write_behind=False, slow_query_ms=None, startup=None, backup_minutes=None,
+                 server=None, server_token=None, offline_first=False, terminal=0):
         super().__init__()
-        self.db = DatabaseManager()
-        self.current_sale_items = []
+        self.startup = startup or StartupTimer()
+        self.sync = None
+        if server and offline_first:
+            # Sells from a database of its own; the sync agent trades sales
+            # and catalog changes with the store whenever it can reach it
+            self.db = DatabaseManager('till.db', write_behind=write_behind, terminal=terminal)
+            self.sync = SyncAgent(self.db, BakeryClient(server, server_token))
+            self.inventory = ReplicaInventory(self.db, self.sync)
+            self.sales = SalesService(self.db)
+            self.invoicing = InvoicingService(self.db)
+            self.reporting = ReportingService(self.db)
+        elif server:
+            # A thin client: the store server owns the database, its profile
+            # and its backups
+            self.db = RemoteDatabase(BakeryClient(server, server_token))
+            self.inventory = RemoteInventory(self.db)
+            self.sales = RemoteSales(self.db)
+            self.invoicing = RemoteInvoicing(self.db)
+            self.reporting = RemoteReporting(self.db)
+        else:
+            self.db = DatabaseManager(write_behind=write_behind)
+            self.inventory = InventoryService(self.db)
+            self.sales = SalesService(self.db)
+            self.invoicing = InvoicingService(self.db)
+            self.reporting = ReportingService(self.db)
+        self.startup.mark('database')
+        if slow_query_ms is not None:
+            self.db.start_profiling(slow_query_ms, self.db.db_name + '.slow.log')
+        self.db_runner = QueryRunner(self.db, self)
+        # Thumbnails are read on a runner of their own, so a checkout never
+        # waits behind a grid full of them
+        self.image_runner = QueryRunner(self.db, self, max_threads=1)
+        self.pixmap_cache = PixmapCache(self.db, self.image_runner)
+        self.backups = None
+        if backup_minutes and not server:
+            # Snapshots are taken on their own thread and never hold a write lock
+            self.backups = BackupManager(self.db)
+            self.backups.start(backup_minutes * 60)
+        self.cart = Cart()
         self.last_clear_time = datetime.now()
+        self._tile_sync = None
         self._init_ui()
+        if self.sync is not None:
+            self.sync_label = QLabel()
+            self.statusBar().addPermanentWidget(self.sync_label)
+            self._catalog_updates = 0
+            self.sync_timer = QTimer(self)
+            self.sync_timer.timeout.connect(self._show_sync_status)
+            self.sync_timer.start(1000)
+            self.sync.start()
+    
+    def closeEvent(self, event):
+        self.db_runner.shutdown()
+        self.image_runner.shutdown()
+        if self.backups is not None:
+            self.backups.stop()
+        if self.sync is not None:
+            # Unsent sales stay in till.db and go out on the next start
+            self.sync.stop()
+        profile = self.db.query_profile()
+        if profile is not None:
+            for stats in profile['statements']:
+                print(f"{stats['total_ms']:10.1f} ms {stats['calls']:7d} calls {stats['rows']:8d} rows  "
+                      f"{stats['sql'][:100]}")
+        self.db.close()
+        super().closeEvent(event)
+    
+    def _show_sync_status(self):
+        status = self.sync.status()
+        if status['online'] is None:
+            text = "Store: connecting"
+        elif status['online']:
+            text = "Store: online"
+        else:
+            text = "Store: OFFLINE"
+        text += f" | {status['pending']} sales to send"
+        if status['pending']:
+            lag = status['lag']
+            text += f", oldest {lag:.0f}s ago" if lag < 120 else f", oldest {lag / 60:.0f} min ago"
+        if status['last_sync']:
+            text += f" | synced {status['last_sync'].strftime('%H:%M:%S')}"
+        if status['pushed']:
+            text += f" | last batch {status['rate']:.0f} sales/s, {status['compression']:.1f}x compressed"
+        self.sync_label.setText(text)
+        self.sync_label.setToolTip(str(status['last_error'] or ''))
+        
+        # Catalog changes made at another till or in the back office
+        if self.sync.catalog_updates != self._catalog_updates:
+            self._catalog_updates = self.sync.catalog_updates
+            self._load_item_buttons()
+            if hasattr(self, 'items_table'):
+                self._load_items()
     
     def _init_ui(self):
         self.setWindowTitle("Bakery Management System")
@@ -180,15 +732,30 @@ class BakeryApp(QMainWindow):
         self.setCentralWidget(main_widget)
         layout = QVBoxLayout(main_widget)
         
-        tabs = QTabWidget()
+        self.tabs = tabs = QTabWidget()
         layout.addWidget(tabs)
         
         self._create_sales_tab(tabs)
-        self._create_reports_tab(tabs)
-        self._create_inventory_tab(tabs)
+        self.startup.mark('sales_tab')
+        
+        # The other tabs are built the first time they are opened, so the
+        # till is usable before the inventory images or history are read
+        self._lazy_tabs = {}
+        self._add_lazy_tab(tabs, "Reports", self._create_reports_tab)
+        self._add_lazy_tab(tabs, "Inventory", self._create_inventory_tab)
+        tabs.currentChanged.connect(self._build_lazy_tab)
+    
+    def _add_lazy_tab(self, tabs, title, build):
+        page = QWidget()
+        self._lazy_tabs[page] = build
+        tabs.addTab(page, title)
+    
+    def _build_lazy_tab(self, index):
+        build = self._lazy_tabs.pop(self.tabs.widget(index), None)
+        if build is not None:
+            build(self.tabs.widget(index))
     
-    def _create_inventory_tab(self, tabs):
-        inventory_tab = QWidget()
+    def _create_inventory_tab(self, inventory_tab):
         layout = QVBoxLayout(inventory_tab)
         
         # Add item section
@@ -235,7 +802,6 @@ class BakeryApp(QMainWindow):
         self.items_table.setHorizontalHeaderLabels(["ID", "Name", "Price", "Image", "Actions"])
         layout.addWidget(self.items_table)
         
-        tabs.addTab(inventory_tab, "Inventory")
         self._load_items()
     
     def _setup_image_upload(self, layout):
@@ -268,6 +834,16 @@ class BakeryApp(QMainWindow):
         """)
         refresh_btn.clicked.connect(self._load_items)
         button_layout.addWidget(refresh_btn)
+        
+        import_btn = QPushButton("Import Catalog")
+        import_btn.setStyleSheet(refresh_btn.styleSheet())
+        import_btn.clicked.connect(self._import_catalog)
+        button_layout.addWidget(import_btn)
+        
+        export_btn = QPushButton("Export Catalog")
+        export_btn.setStyleSheet(refresh_btn.styleSheet())
+        export_btn.clicked.connect(self._export_catalog)
+        button_layout.addWidget(export_btn)
         layout.addLayout(button_layout)
     
     def _select_image(self):
@@ -290,42 +866,71 @@ class BakeryApp(QMainWindow):
             QMessageBox.warning(self, "Error", "Please enter an item name")
             return
         
-        try:
-            image_data = None
-            if self.image_path:
-                with open(self.image_path, 'rb') as image_file:
-                    image_data = base64.b64encode(image_file.read()).decode('utf-8')
-            
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('INSERT INTO items (name, price, image_data) VALUES (?, ?, ?)',
-                              (name, price, image_data))
-                conn.commit()
-            
-            self._load_items()
-            self._load_item_buttons()
-            self.item_name.clear()
-            self.item_price.setValue(0)
-            self.image_path = None
-            self.image_preview.clear()
-            self.image_preview.setStyleSheet("border: 1px solid #ccc;")
-            
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to add item: {str(e)}")
+        self.db_runner.submit(None, self._store_new_item, name, price, self.image_path,
+                              on_result=self._item_added,
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to add item: {str(e)}"))
+    
+    def _store_new_item(self, name, price, image_path):
+        """Runs on a db_runner thread"""
+        image_data = thumbnails = None
+        if image_path:
+            with open(image_path, 'rb') as image_file:
+                image_data = image_file.read()
+            thumbnails = render_thumbnails(image_data)
+        return self.inventory.add_item(name, price, image_data, thumbnails)
+    
+    def _item_added(self, item_id):
+        self._load_items()
+        self._load_item_buttons()
+        self.item_name.clear()
+        self.item_price.setValue(0)
+        self.image_path = None
+        self.image_preview.clear()
+        self.image_preview.setStyleSheet("border: 1px solid #ccc;")
+    
+    def _import_catalog(self):
+        file_name, _ = QFileDialog.getOpenFileName(
+            self,
+            "Import Catalog",
+            "",
+            "Catalog Files (*.csv *.json)"
+        )
+        if not file_name:
+            return
+        # Images are thumbnailed in a process pool off the UI thread; the
+        # item views are rebuilt once, when the whole import has landed
+        self.db_runner.submit(None, self.inventory.import_catalog, file_name, None, render_thumbnails,
+                              on_result=self._catalog_imported,
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to import catalog: {str(e)}"))
+    
+    def _catalog_imported(self, result):
+        added, updated = result
+        self._load_items()
+        self._load_item_buttons()
+        QMessageBox.information(self, "Import Catalog", f"{added} items added, {updated} updated")
+    
+    def _export_catalog(self):
+        file_name, _ = QFileDialog.getSaveFileName(
+            self,
+            "Export Catalog",
+            "catalog.csv",
+            "CSV Files (*.csv);;JSON Files (*.json)"
+        )
+        if not file_name:
+            return
+        self.db_runner.submit(None, self.inventory.export_catalog, file_name,
+                              on_result=lambda count: QMessageBox.information(
+                                  self, "Export Catalog", f"{count} items exported to {file_name}"),
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to export catalog: {str(e)}"))
     
     def _load_items(self):
-        try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT * FROM items')
-                items = cursor.fetchall()
-            
-            self.items_table.setRowCount(len(items))
-            for i, item in enumerate(items):
-                self._populate_item_row(i, item)
-                
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to load items: {str(e)}")
+        self.db_runner.submit('items', self.inventory.list_items, on_result=self._show_items,
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to load items: {str(e)}"))
+    
+    def _show_items(self, items):
+        self.items_table.setRowCount(len(items))
+        for i, item in enumerate(items):
+            self._populate_item_row(i, item)
     
     def _populate_item_row(self, row, item):
         self.items_table.setItem(row, 0, QTableWidgetItem(str(item[0])))
@@ -333,20 +938,34 @@ class BakeryApp(QMainWindow):
         self.items_table.setItem(row, 2, QTableWidgetItem(f"${item[2]:.2f}"))
         
         if item[3]:
-            try:
-                image_data = base64.b64decode(item[3])
-                pixmap = QPixmap()
-                pixmap.loadFromData(image_data)
-                image_label = QLabel()
-                image_label.setPixmap(pixmap.scaled(50, 50, Qt.AspectRatioMode.KeepAspectRatio))
-                self.items_table.setCellWidget(row, 3, image_label)
-            except Exception:
-                self.items_table.setItem(row, 3, QTableWidgetItem("No Image"))
+            pixmap = self.pixmap_cache.pixmap(item[0], item[3], CELL_THUMBNAIL,
+                                              on_loaded=partial(self._item_thumbnail_loaded, row, item))
+            if pixmap is None:
+                # Filled in when the thumbnail has been read
+                self.items_table.removeCellWidget(row, 3)
+                self.items_table.setItem(row, 3, QTableWidgetItem(""))
+            else:
+                self._show_item_thumbnail(row, pixmap)
         else:
-            self.items_table.setItem(row, 3, QTableWidgetItem("No Image"))
+            self._show_item_thumbnail(row, None)
         
         self._add_row_buttons(row, item[0])
     
+    def _item_thumbnail_loaded(self, row, item, pixmap):
+        # The table may have been reloaded with another item in that row since
+        cell = self.items_table.item(row, 0)
+        if cell is not None and cell.text() == str(item[0]):
+            self._show_item_thumbnail(row, pixmap)
+    
+    def _show_item_thumbnail(self, row, pixmap):
+        if pixmap:
+            image_label = QLabel()
+            image_label.setPixmap(pixmap)
+            self.items_table.setCellWidget(row, 3, image_label)
+        else:
+            self.items_table.removeCellWidget(row, 3)
+            self.items_table.setItem(row, 3, QTableWidgetItem("No Image"))
+    
     def _add_row_buttons(self, row, item_id):
         buttons_widget = QWidget()
         buttons_layout = QHBoxLayout(buttons_widget)
@@ -364,54 +983,55 @@ class BakeryApp(QMainWindow):
         self.items_table.setCellWidget(row, 4, buttons_widget)
     
     def _edit_item(self, row):
-        try:
-            item_id = int(self.items_table.item(row, 0).text())
-            
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT * FROM items WHERE id = ?', (item_id,))
-                item_data = cursor.fetchone()
-            
-            if not item_data:
-                raise Exception("Item not found")
-            
-            dialog = EditItemDialog(self, item_data)
-            if dialog.exec() == QDialog.DialogCode.Accepted:
-                updated_data = dialog.get_updated_data()
-                
-                with self.db.get_connection() as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        UPDATE items 
-                        SET name = ?, price = ?, image_data = ?
-                        WHERE id = ?
-                    ''', (updated_data['name'], updated_data['price'], 
-                          updated_data['image_data'], item_id))
-                    conn.commit()
-                
-                self._load_items()
-                self._load_item_buttons()
-                
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to edit item: {str(e)}")
+        item_id = int(self.items_table.item(row, 0).text())
+        self.db_runner.submit('edit_item', self.inventory.get_item, item_id,
+                              on_result=partial(self._open_edit_dialog, item_id),
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to edit item: {str(e)}"))
+    
+    def _open_edit_dialog(self, item_id, item_data):
+        if not item_data:
+            QMessageBox.warning(self, "Error", "Failed to edit item: Item not found")
+            return
+        
+        dialog = EditItemDialog(self, item_data, self.pixmap_cache)
+        if dialog.exec() == QDialog.DialogCode.Accepted:
+            updated_data = dialog.get_updated_data()
+            self.db_runner.submit(None, self._store_item_edit, item_id, updated_data, item_data[3],
+                                  on_result=partial(self._item_edited, item_id, item_data[3]),
+                                  on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to edit item: {str(e)}"))
+    
+    def _store_item_edit(self, item_id, updated_data, image_hash):
+        """Runs on a db_runner thread; returns the item's image hash"""
+        image_data = thumbnails = None
+        if updated_data['image_path']:
+            with open(updated_data['image_path'], 'rb') as image_file:
+                image_data = image_file.read()
+            thumbnails = render_thumbnails(image_data)
+        # The new image is stored in the same transaction as the item that
+        # refers to it
+        return self.inventory.update_item(item_id, updated_data['name'], updated_data['price'],
+                                          image_hash, image_data, thumbnails)
+    
+    def _item_edited(self, item_id, old_image_hash, image_hash):
+        if image_hash != old_image_hash:
+            self.pixmap_cache.invalidate(item_id)
+        self._load_items()
+        self._load_item_buttons()
     
     def _delete_item(self, row):
-        try:
-            item_id = int(self.items_table.item(row, 0).text())
-            
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM items WHERE id = ?', (item_id,))
-                conn.commit()
-            
-            self._load_items()
-            self._load_item_buttons()
-            
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to delete item: {str(e)}")
+        item_id = int(self.items_table.item(row, 0).text())
+        self.db_runner.submit(None, self.inventory.delete_item, item_id,
+                              on_result=lambda result: self._item_deleted(item_id),
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to delete item: {str(e)}"))
+    
+    def _item_deleted(self, item_id):
+        self.pixmap_cache.invalidate(item_id)
+        self._load_items()
+        self._load_item_buttons()
 
     def _create_sales_tab(self, tabs):
         sales_tab = QWidget()
+        self.sales_tab = sales_tab
         layout = QVBoxLayout(sales_tab)
         
         sales_layout = QHBoxLayout()
@@ -425,9 +1045,30 @@ class BakeryApp(QMainWindow):
         scroll.setFrameShape(QFrame.Shape.NoFrame)
         
         buttons_widget = QWidget()
+        # Styled once here rather than per tile
+        buttons_widget.setStyleSheet("""
+            QPushButton#itemButton {
+                padding: 2px;
+                border: 1px solid #ccc;
+                border-radius: 3px;
+                background-color: #f0f0f0;
+            }
+            QPushButton#itemButton:hover {
+                background-color: #e0e0e0;
+            }
+            QLabel#itemName {
+                font-size: 11px;
+                font-weight: bold;
+            }
+            QLabel#itemPrice {
+                font-size: 10px;
+                color: #666;
+            }
+        """)
         self.buttons_layout = QGridLayout(buttons_widget)
         self.buttons_layout.setSpacing(2)
         self.buttons_layout.setContentsMargins(2, 2, 2, 2)
+        self.item_buttons = {}
         
         scroll.setWidget(buttons_widget)
         left_layout.addWidget(scroll)
@@ -444,6 +1085,8 @@ class BakeryApp(QMainWindow):
         self.current_sale_table.setColumnWidth(2, 80)
         self.current_sale_table.setColumnWidth(3, 80)
         self.current_sale_table.setColumnWidth(4, 60)
+        # The table only displays self.cart: item id -> (name, quantity, total) cells
+        self.cart_cells = {}
         right_layout.addWidget(self.current_sale_table)
         
         # Total and buttons section
@@ -515,106 +1158,75 @@ class BakeryApp(QMainWindow):
         tabs.addTab(sales_tab, "Sales")
         self._load_item_buttons()
 
-    def _handle_delete_row(self, row):
-        """More reliable row deletion handler"""
-        if 0 <= row < self.current_sale_table.rowCount():
-            self.current_sale_table.removeRow(row)
-            # Reset the row count to ensure proper cleanup
-            remaining_rows = self.current_sale_table.rowCount()
-            self.current_sale_table.setRowCount(remaining_rows)
-            self._update_total()
+    def _load_item_buttons(self):
+        self.db_runner.submit('item_buttons', self.inventory.list_items, on_result=self._sync_item_buttons,
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to load items: {str(e)}"))
     
+    def _sync_item_buttons(self, items):
+        """Bring the sales grid in line with the catalog, touching only the
+        tiles whose item was added, changed or removed"""
+        current_ids = {item[0] for item in items}
+        for item_id in [item_id for item_id in self.item_buttons if item_id not in current_ids]:
+            tile = self.item_buttons.pop(item_id)
+            self.buttons_layout.removeWidget(tile)
+            tile.deleteLater()
+        
+        # New tiles are built a batch per event-loop pass, so the grid fills
+        # in while the window stays responsive
+        self._tile_sync = self._place_item_tiles(items)
+        self._continue_tile_sync()
     
-    def _load_item_buttons(self):
-        for i in reversed(range(self.buttons_layout.count())): 
-            self.buttons_layout.itemAt(i).widget().setParent(None)
-        
-        with self.db.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id, name, price, image_data FROM items')
-            items = cursor.fetchall()
-        
-        button_width = 120
-        button_height = 100
-        
-        row = 0
-        col = 0
-        for item in items:
-            container = QWidget()
-            container.setFixedSize(button_width, button_height + 40)
-            container_layout = QVBoxLayout(container)
-            container_layout.setSpacing(2)
-            container_layout.setContentsMargins(2, 2, 2, 2)
-            
-            btn = QPushButton()
-            btn.setFixedSize(button_width - 4, button_height - 4)
-            btn.setStyleSheet("""
-                QPushButton {
-                    padding: 2px;
-                    border: 1px solid #ccc;
-                    border-radius: 3px;
-                    background-color: #f0f0f0;
-                }
-                QPushButton:hover {
-                    background-color: #e0e0e0;
-                }
-            """)
-            
-            if item[3]:
-                try:
-                    image_data = base64.b64decode(item[3])
-                    pixmap = QPixmap()
-                    pixmap.loadFromData(image_data)
-                    scaled_pixmap = pixmap.scaled(
-                        button_width - 8,
-                        button_height - 8,
-                        Qt.AspectRatioMode.KeepAspectRatio,
-                        Qt.TransformationMode.SmoothTransformation
-                    )
-                    btn.setIcon(QIcon(scaled_pixmap))
-                    btn.setIconSize(scaled_pixmap.size())
-                except:
-                    pass
-            
-            name_label = QLabel(item[1])
-            name_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            name_label.setStyleSheet("font-size: 11px; font-weight: bold;")
-            name_label.setWordWrap(True)
-            
-            price_label = QLabel(f"${item[2]:.2f}")
-            price_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
-            price_label.setStyleSheet("font-size: 10px; color: #666;")
-            
-            container_layout.addWidget(btn)
-            container_layout.addWidget(name_label)
-            container_layout.addWidget(price_label)
+    def _continue_tile_sync(self):
+        if self._tile_sync is None:
+            return
+        if not next(self._tile_sync, False):
+            self._tile_sync = None
+            self.startup.finish('item_grid')
+        else:
+            QTimer.singleShot(0, self._continue_tile_sync)
+    
+    def _place_item_tiles(self, items):
+        built = 0
+        for index, item in enumerate(items):
+            tile = self.item_buttons.get(item[0])
+            if tile is None:
+                tile = ItemButton(item, self.pixmap_cache, self._add_to_sale)
+                self.item_buttons[item[0]] = tile
+                built += 1
+            else:
+                tile.set_item(item)
             
-            btn.clicked.connect(lambda checked, item_id=item[0], name=item[1], price=item[2]: 
-                              self._add_to_sale(item_id, name, price))
+            # Reflow: only tiles whose grid cell changed are moved
+            position = divmod(index, self.ITEM_GRID_COLUMNS)
+            if tile.grid_position != position:
+                if tile.grid_position is not None:
+                    self.buttons_layout.removeWidget(tile)
+                self.buttons_layout.addWidget(tile, *position)
+                tile.grid_position = position
             
-            self.buttons_layout.addWidget(container, row, col)
-            col += 1
-            if col > 3:
-                col = 0
-                row += 1
+            if built == self.ITEM_TILE_BATCH:
+                built = 0
+                yield True
     
     def _add_to_sale(self, item_id, name, price):
-        for i in range(self.current_sale_table.rowCount()):
-            if self.current_sale_table.item(i, 0).text() == name:
-                current_qty = int(self.current_sale_table.item(i, 1).text())
-                new_qty = current_qty + 1
-                self.current_sale_table.setItem(i, 1, QTableWidgetItem(str(new_qty)))
-                self.current_sale_table.setItem(i, 3, QTableWidgetItem(f"${price * new_qty:.2f}"))
-                self._update_total()
-                return
+        line = self.cart.add(item_id, name, to_cents(price))
+        cells = self.cart_cells.get(item_id)
+        if cells:
+            cells[1].setText(str(line.quantity))
+            cells[2].setText(format_money(line.total))
+            self._update_total()
+            return
         
         row = self.current_sale_table.rowCount()
         self.current_sale_table.insertRow(row)
         
-        self.current_sale_table.setItem(row, 0, QTableWidgetItem(name))
-        self.current_sale_table.setItem(row, 1, QTableWidgetItem("1"))
-        self.current_sale_table.setItem(row, 2, QTableWidgetItem(f"${price:.2f}"))
-        self.current_sale_table.setItem(row, 3, QTableWidgetItem(f"${price:.2f}"))
+        cells = (QTableWidgetItem(name), QTableWidgetItem(str(line.quantity)),
+                 QTableWidgetItem(format_money(line.total)))
+        self.cart_cells[item_id] = cells
+        self.current_sale_table.setItem(row, 0, cells[0])
+        self.current_sale_table.setItem(row, 1, cells[1])
+        self.current_sale_table.setItem(row, 2, QTableWidgetItem(format_money(line.unit_price)))
+        self.current_sale_table.setItem(row, 3, cells[2])
         
         delete_btn = QPushButton("×")
         delete_btn.setFixedSize(30, 30)
@@ -631,7 +1243,7 @@ class BakeryApp(QMainWindow):
                 border-radius: 3px;
             }
         """)
-        delete_btn.clicked.connect(lambda: self._remove_from_sale(row))
+        delete_btn.clicked.connect(lambda checked, item_id=item_id: self._remove_from_sale(item_id))
         
         button_widget = QWidget()
         button_layout = QHBoxLayout(button_widget)
@@ -643,72 +1255,56 @@ class BakeryApp(QMainWindow):
         self._update_total()
     
     def _update_total(self):
-        total = 0
-        for row in range(self.current_sale_table.rowCount()):
-            total += float(self.current_sale_table.item(row, 3).text().replace("$", ""))
-        self.total_label.setText(f"Total: ${total:.2f}")
-        self.total_lbp_label.setText(f"Total: LBP {int(total * 90000):,}")
+        self.total_label.setText(f"Total: {format_money(self.cart.total)}")
+        self.total_lbp_label.setText(f"Total: LBP {format_lbp(self.cart.total)}")
     
     def _make_sale(self):
-        if self.current_sale_table.rowCount() == 0:
+        if not self.cart:
             QMessageBox.warning(self, "Error", "No items in current sale")
             return
 
-        try:
-            invoice_number = self._get_next_invoice_number()
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("BEGIN TRANSACTION")
-
-                for row in range(self.current_sale_table.rowCount()):
-                    item_name = self.current_sale_table.item(row, 0).text()
-                    quantity = int(self.current_sale_table.item(row, 1).text())
-                    total_price = float(self.current_sale_table.item(row, 3).text().replace("$", ""))
-
-                    cursor.execute('SELECT id FROM items WHERE name = ?', (item_name,))
-                    item = cursor.fetchone()
-
-                    if not item:
-                        raise Exception(f"Item {item_name} not found")
-
-                    cursor.execute('''
-                        INSERT INTO sales (item_id, quantity, total_price, sale_date)
-                        VALUES (?, ?, ?, ?)
-                    ''', (item[0], quantity, total_price, datetime.now()))
-
-                cursor.execute("COMMIT")
-
-            self._show_receipt(invoice_number)
-            self.current_sale_table.setRowCount(0)
-            self._update_total()
-
-        except Exception as e:
-            QMessageBox.warning(self, "Error", str(e))
+        # The sale is written from a snapshot; the till is locked until it lands
+        lines = [CartLine(line.item_id, line.name, line.unit_price, line.quantity) for line in self.cart]
+        self.sales_tab.setEnabled(False)
+        self.db_runner.submit(None, self.sales.checkout, lines,
+                              on_result=lambda result: self._sale_recorded(lines, result),
+                              on_error=self._sale_failed)
     
-    def _show_receipt(self, invoice_number):
+    def _sale_recorded(self, lines, result):
+        invoice_id, invoice_number, sale_time = result
+        if self.sync is not None:
+            self.sync.notify()
+        self.sales_tab.setEnabled(True)
+        self._reset_cart()
+        self._show_receipt(invoice_number, sale_time, lines)
+    
+    def _sale_failed(self, error):
+        self.sales_tab.setEnabled(True)
+        QMessageBox.warning(self, "Error", str(error))
+    
+    def _show_receipt(self, invoice_number, sale_time, lines):
         receipt = f"=== BAKERY RECEIPT ===\n\nInvoice #: INV-{invoice_number:04d}\n"
-        receipt += f"Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
+        receipt += f"Date: {sale_time.strftime('%Y-%m-%d %H:%M:%S')}\n\n"
 
         html = f"""
         <h2>Bakery Receipt</h2>
         <p><strong>Invoice #:</strong> INV-{invoice_number:04d}<br>
-        <strong>Date:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+        <strong>Date:</strong> {sale_time.strftime('%Y-%m-%d %H:%M:%S')}</p>
         <hr><ul>
         """
 
-        total = 0
-        for row in range(self.current_sale_table.rowCount()):
-            item = self.current_sale_table.item(row, 0).text()
-            qty = self.current_sale_table.item(row, 1).text()
-            price = self.current_sale_table.item(row, 2).text()
-            total_item = self.current_sale_table.item(row, 3).text()
-            total += float(total_item.replace("$", ""))
-
-            receipt += f"{item}\n  {qty} x {price} = {total_item}\n"
-            html += f"<li>{item} - {qty} x {price} = {total_item}</li>"
+        total_cents = 0
+        for line in lines:
+            total_cents += line.total
+            price = format_money(line.unit_price)
+            total_item = format_money(line.total)
+            receipt += f"{line.name}\n  {line.quantity} x {price} = {total_item}\n"
+            html += f"<li>{line.name} - {line.quantity} x {price} = {total_item}</li>"
 
-        receipt += f"\nTotal: ${total:.2f}\nTotal: LBP {int(total * 90000):,}\nThank you for your purchase!"
-        html += f"</ul><hr><p><strong>Total:</strong> ${total:.2f}<br><strong>Total (LBP):</strong> {int(total * 90000):,}</p>"
+        total = format_money(total_cents)
+        total_lbp = format_lbp(total_cents)
+        receipt += f"\nTotal: {total}\nTotal: LBP {total_lbp}\nThank you for your purchase!"
+        html += f"</ul><hr><p><strong>Total:</strong> {total}<br><strong>Total (LBP):</strong> {total_lbp}</p>"
 
         dialog = QDialog(self)
         dialog.setWindowTitle("Receipt")
@@ -751,18 +1347,24 @@ class BakeryApp(QMainWindow):
         dialog.exec()
 
     
-    def _remove_from_sale(self, row):
+    def _remove_from_sale(self, item_id):
         try:
-            if self.current_sale_table.rowCount() > 0:
-                self.current_sale_table.removeRow(row)
-                # Force immediate update of the table
-                self.current_sale_table.setRowCount(self.current_sale_table.rowCount())
-                self._update_total()
+            self.cart.remove(item_id)
+            cells = self.cart_cells.pop(item_id, None)
+            if cells:
+                self.current_sale_table.removeRow(self.current_sale_table.row(cells[0]))
+            self._update_total()
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Failed to remove item: {str(e)}")
 
+    def _reset_cart(self):
+        self.cart.clear()
+        self.cart_cells.clear()
+        self.current_sale_table.setRowCount(0)
+        self._update_total()
+
     def _clear_sale(self):
-        if self.current_sale_table.rowCount() > 0:
+        if self.cart:
             reply = QMessageBox.question(
                 self,
                 "Clear Sale",
@@ -772,40 +1374,9 @@ class BakeryApp(QMainWindow):
             )
             
             if reply == QMessageBox.StandardButton.Yes:
-                self.current_sale_table.setRowCount(0)
-                self._update_total()
+                self._reset_cart()
 
-    def _get_next_invoice_number(self):
-        try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                
-                # Clear out any old entries (older than 30 days)
-                cursor.execute("DELETE FROM daily_invoice_count WHERE date < date('now', '-30 days')")
-                
-                # Get or create today's count
-                cursor.execute('SELECT count FROM daily_invoice_count WHERE date = ?', (today,))
-                result = cursor.fetchone()
-                
-                if result:
-                    count = result[0] + 1
-                    cursor.execute('UPDATE daily_invoice_count SET count = ? WHERE date = ?', 
-                                 (count, today))
-                else:
-                    count = 1
-                    cursor.execute('INSERT INTO daily_invoice_count (date, count) VALUES (?, ?)', 
-                                 (today, count))
-                
-                conn.commit()
-                return count
-                
-        except Exception as e:
-            print(f"Error getting invoice number: {e}")
-            return 1  # Fallback
-
-    def _create_reports_tab(self, tabs):
-        reports_tab = QWidget()
+    def _create_reports_tab(self, reports_tab):
         layout = QVBoxLayout(reports_tab)
         
         reports_layout = QHBoxLayout()
@@ -842,25 +1413,69 @@ class BakeryApp(QMainWindow):
         left_layout.addWidget(view_history_btn)
         left_layout.addWidget(clear_invoices_btn)
         
+        if self.db.profile is not None:
+            profile_btn = QPushButton("Query Profile")
+            profile_btn.clicked.connect(self._show_query_profile)
+            left_layout.addWidget(profile_btn)
+        
         # Right side - Invoice history table
         right_panel = QWidget()
         right_layout = QVBoxLayout(right_panel)
         
+        # Searches the whole history once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(300)
+        self.search_timer.timeout.connect(self._load_invoice_history)
+        
         search_layout = QHBoxLayout()
         search_label = QLabel("Search Invoice:")
         self.search_input = QLineEdit()
-        self.search_input.setPlaceholderText("Enter invoice number (e.g., INV-0001)")
-        self.search_input.textChanged.connect(self._filter_invoices)
+        self.search_input.setPlaceholderText("Invoice number (e.g., INV-0001)")
+        self.search_input.textChanged.connect(self.search_timer.start)
+        self.search_item = QLineEdit()
+        self.search_item.setPlaceholderText("Item name")
+        self.search_item.textChanged.connect(self.search_timer.start)
         search_layout.addWidget(search_label)
         search_layout.addWidget(self.search_input)
+        search_layout.addWidget(self.search_item)
         right_layout.addLayout(search_layout)
         
-        self.history_table = QTableWidget()
-        self.history_table.setColumnCount(5)
-        self.history_table.setHorizontalHeaderLabels(["Invoice #", "Date", "Items Count", "Total", "Details"])
+        range_layout = QHBoxLayout()
+        self.search_from = self._search_date_edit()
+        self.search_to = self._search_date_edit()
+        self.search_min_total = self._search_total_edit()
+        self.search_max_total = self._search_total_edit()
+        range_layout.addWidget(QLabel("From:"))
+        range_layout.addWidget(self.search_from)
+        range_layout.addWidget(QLabel("To:"))
+        range_layout.addWidget(self.search_to)
+        range_layout.addWidget(QLabel("Total:"))
+        range_layout.addWidget(self.search_min_total)
+        range_layout.addWidget(QLabel("-"))
+        range_layout.addWidget(self.search_max_total)
+        right_layout.addLayout(range_layout)
+        
+        self.history_model = InvoiceHistoryModel(self.invoicing, self.db_runner, self)
+        self.history_model.load_failed.connect(
+            lambda message: QMessageBox.warning(self, "Error", f"Failed to load invoice history: {message}"))
+        self.history_table = QTableView()
+        self.history_table.setModel(self.history_model)
+        self.history_table.setMouseTracking(True)
+        self.history_table.verticalHeader().setVisible(False)
         self.history_table.horizontalHeader().setStretchLastSection(True)
+        self.history_table.horizontalHeader().setSortIndicator(1, Qt.SortOrder.DescendingOrder)
         self.history_table.setSortingEnabled(True)
-        self.history_table.horizontalHeader().sectionClicked.connect(self._sort_table)
+        
+        details_delegate = ViewDetailsDelegate(self.history_table)
+        details_delegate.clicked.connect(self._show_invoice_details)
+        self.history_table.setItemDelegateForColumn(InvoiceHistoryModel.DETAILS_COLUMN, details_delegate)
+        
+        self.history_table.setColumnWidth(0, 120)
+        self.history_table.setColumnWidth(1, 150)
+        self.history_table.setColumnWidth(2, 100)
+        self.history_table.setColumnWidth(3, 100)
+        self.history_table.setColumnWidth(4, 90)
         
         right_layout.addWidget(self.history_table)
         
@@ -869,77 +1484,64 @@ class BakeryApp(QMainWindow):
         
         layout.addLayout(reports_layout)
         
-        tabs.addTab(reports_tab, "Reports")
         self._load_invoice_history()
     
+    def _search_date_edit(self):
+        edit = QDateEdit()
+        edit.setCalendarPopup(True)
+        edit.setDisplayFormat("yyyy-MM-dd")
+        # The minimum date stands for "no limit"
+        edit.setMinimumDate(QDate(2000, 1, 1))
+        edit.setSpecialValueText("Any")
+        edit.setDate(edit.minimumDate())
+        edit.dateChanged.connect(self.search_timer.start)
+        return edit
+    
+    def _search_total_edit(self):
+        edit = QDoubleSpinBox()
+        edit.setRange(0, 1000000)
+        edit.setPrefix("$")
+        edit.setSpecialValueText("Any")
+        edit.valueChanged.connect(self.search_timer.start)
+        return edit
+    
+    def _invoice_search(self):
+        """The criteria typed into the search fields"""
+        def date_or_none(edit):
+            return None if edit.date() == edit.minimumDate() else edit.date().toPyDate()
+        
+        def total_or_none(edit):
+            return edit.value() or None
+        
+        return InvoiceSearch(
+            number=InvoiceSearch.parse_number(self.search_input.text()),
+            start=date_or_none(self.search_from),
+            end=date_or_none(self.search_to),
+            min_total=total_or_none(self.search_min_total),
+            max_total=total_or_none(self.search_max_total),
+            item=self.search_item.text().strip() or None,
+        )
+    
+    def _clear_invoice_search(self):
+        for edit in (self.search_input, self.search_item):
+            edit.clear()
+        for edit in (self.search_from, self.search_to):
+            edit.setDate(edit.minimumDate())
+        for edit in (self.search_min_total, self.search_max_total):
+            edit.setValue(0)
+    
     def _load_invoice_history(self):
+        self.search_timer.stop()
         try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT 
-                        MIN(s.id) as sale_id,
-                        s.sale_date,
-                        COUNT(DISTINCT s.item_id) as unique_items,
-                        SUM(s.quantity) as total_quantity,
-                        SUM(s.total_price) as total_price
-                    FROM sales s
-                    WHERE s.sale_date > ?
-                    GROUP BY strftime('%Y-%m-%d %H:%M:%S', s.sale_date)
-                    ORDER BY s.sale_date DESC
-                ''', (self.last_clear_time,))
-                sales = cursor.fetchall()
-            
-            self.history_table.setSortingEnabled(False)
-            self.history_table.setRowCount(len(sales))
-            
-            # Get today's count once at the beginning
-            today = datetime.now().strftime('%Y-%m-%d')
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT count FROM daily_invoice_count WHERE date = ?', (today,))
-                result = cursor.fetchone()
-                base_count = result[0] if result else 0
-            
-            for i, sale in enumerate(sales):
-                # Use the base count plus the reverse index to maintain order
-                invoice_num = f"INV-{(base_count - i):04d}"
-                self.history_table.setItem(i, 0, QTableWidgetItem(invoice_num))
-                
-                date = datetime.strptime(sale[1], '%Y-%m-%d %H:%M:%S.%f')
-                self.history_table.setItem(i, 1, QTableWidgetItem(date.strftime('%Y-%m-%d %H:%M')))
-                
-                self.history_table.setItem(i, 2, QTableWidgetItem(str(sale[3])))
-                self.history_table.setItem(i, 3, QTableWidgetItem(f"${sale[4]:.2f}"))
-                
-                view_btn = QPushButton("View Details")
-                view_btn.setStyleSheet("""
-                    QPushButton {
-                        padding: 3px;
-                        background-color: #e3f2fd;
-                        border: 1px solid #2196f3;
-                        border-radius: 3px;
-                        color: #1976d2;
-                        font-size: 11px;
-                    }
-                    QPushButton:hover {
-                        background-color: #bbdefb;
-                    }
-                """)
-                view_btn.clicked.connect(lambda checked, sale_date=sale[1]: self._show_invoice_details(sale_date))
-                self.history_table.setCellWidget(i, 4, view_btn)
-            
-            self.history_table.setSortingEnabled(True)
-            self.history_table.setColumnWidth(0, 120)
-            self.history_table.setColumnWidth(1, 150)
-            self.history_table.setColumnWidth(2, 100)
-            self.history_table.setColumnWidth(3, 100)
-            self.history_table.setColumnWidth(4, 90)
-            
+            # A search covers the whole history, including cleared invoices
+            self.history_model.reload(self.last_clear_time, self._invoice_search())
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Failed to load invoice history: {str(e)}")
 
     def _print_html_invoice(self, html):
+        # Print support is only loaded once somebody prints
+        from PyQt6.QtPrintSupport import QPrinter, QPrintDialog
+        
         document = QTextDocument()
         document.setHtml(html)
 
@@ -948,40 +1550,32 @@ class BakeryApp(QMainWindow):
         if dialog.exec():
             document.print(printer)
 
-    def _show_invoice_details(self, sale_date):
+    def _show_invoice_details(self, invoice_id):
+        self.db_runner.submit('invoice_details', self.invoicing.details, invoice_id,
+                              on_result=self._show_invoice_dialog,
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to show invoice details: {str(e)}"))
+
+    def _show_invoice_dialog(self, details):
+        invoice, items = details
         try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT 
-                        s.sale_date,
-                        i.name,
-                        s.quantity,
-                        s.total_price
-                    FROM sales s
-                    JOIN items i ON s.item_id = i.id
-                    WHERE strftime('%Y-%m-%d %H:%M:%S', s.sale_date) = strftime('%Y-%m-%d %H:%M:%S', ?)
-                    ORDER BY s.id
-                ''', (sale_date,))
-                items = cursor.fetchall()
-            
-            if not items:
+            if not invoice or not items:
                 return
 
             # Prepare invoice text
-            sale_time = datetime.strptime(items[0][0], '%Y-%m-%d %H:%M:%S.%f')
+            sale_time = datetime.fromisoformat(invoice[1])
             html = f"""
             <h2>Invoice Details</h2>
-            <p><strong>Date:</strong> {sale_time.strftime('%Y-%m-%d %H:%M')}</p>
+            <p><strong>Invoice #:</strong> INV-{invoice[0]:04d}<br>
+            <strong>Date:</strong> {sale_time.strftime('%Y-%m-%d %H:%M')}</p>
             <hr>
             <ul>
             """
             total = 0
             for item in items:
-                qty = item[2]
-                unit_price = item[3] / qty
-                html += f"<li>{item[1]} - {qty} x ${unit_price:.2f} = ${item[3]:.2f}</li>"
-                total += item[3]
+                qty = item[1]
+                unit_price = item[2] / qty
+                html += f"<li>{item[0]} - {qty} x ${unit_price:.2f} = ${item[2]:.2f}</li>"
+                total += item[2]
             
             html += f"""
             </ul>
@@ -1018,75 +1612,6 @@ class BakeryApp(QMainWindow):
     def _show_invoice_history(self):
         self._load_invoice_history()
 
-    def _sort_table(self, column):
-        current_order = self.history_table.horizontalHeader().sortIndicatorOrder()
-        
-        if column == 0:
-            rows_data = []
-            for row in range(self.history_table.rowCount()):
-                date_item = self.history_table.item(row, 1)
-                if date_item:
-                    date = datetime.strptime(date_item.text(), '%Y-%m-%d %H:%M')
-                    rows_data.append((row, date))
-            
-            rows_data.sort(key=lambda x: x[1], reverse=(current_order == Qt.SortOrder.AscendingOrder))
-            
-            for new_row, (old_row, _) in enumerate(rows_data):
-                self.history_table.insertRow(new_row)
-                for col in range(self.history_table.columnCount()):
-                    if col == 4:
-                        continue
-                    item = self.history_table.item(old_row + 1, col)
-                    if item:
-                        self.history_table.setItem(new_row, col, QTableWidgetItem(item.text()))
-                
-                button = self.history_table.cellWidget(old_row + 1, 4)
-                if button:
-                    self.history_table.setCellWidget(new_row, 4, button)
-                
-                self.history_table.removeRow(old_row + 1)
-        elif column == 3:
-            rows_data = []
-            for row in range(self.history_table.rowCount()):
-                total_item = self.history_table.item(row, 3)
-                if total_item:
-                    price = float(total_item.text().replace('$', ''))
-                    rows_data.append((row, price))
-            
-            rows_data.sort(key=lambda x: x[1], reverse=(current_order == Qt.SortOrder.AscendingOrder))
-            
-            for new_row, (old_row, _) in enumerate(rows_data):
-                self.history_table.insertRow(new_row)
-                for col in range(self.history_table.columnCount()):
-                    if col == 4:
-                        continue
-                    item = self.history_table.item(old_row + 1, col)
-                    if item:
-                        self.history_table.setItem(new_row, col, QTableWidgetItem(item.text()))
-                
-                button = self.history_table.cellWidget(old_row + 1, 4)
-                if button:
-                    self.history_table.setCellWidget(new_row, 4, button)
-                
-                self.history_table.removeRow(old_row + 1)
-        else:
-            self.history_table.sortItems(column, Qt.SortOrder.AscendingOrder if current_order == Qt.SortOrder.DescendingOrder else Qt.SortOrder.DescendingOrder)
-
-    def _filter_invoices(self):
-        search_text = self.search_input.text().strip().upper()
-        
-        if not search_text:
-            for row in range(self.history_table.rowCount()):
-                self.history_table.setRowHidden(row, False)
-            return
-        
-        for row in range(self.history_table.rowCount()):
-            invoice_item = self.history_table.item(row, 0)
-            if invoice_item and search_text in invoice_item.text().upper():
-                self.history_table.setRowHidden(row, False)
-            else:
-                self.history_table.setRowHidden(row, True)
-
     def _clear_invoice_history(self):
         reply = QMessageBox.question(
             self,
@@ -1097,81 +1622,97 @@ class BakeryApp(QMainWindow):
         )
         
         if reply == QMessageBox.StandardButton.Yes:
-            self.history_table.setRowCount(0)
-            self.search_input.clear()
+            self._clear_invoice_search()
             self.last_clear_time = datetime.now()
+            self._load_invoice_history()
 
-    def _generate_daily_report(self):
-        today = datetime.now().date()
-        try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT i.name, SUM(s.quantity) as total_quantity, SUM(s.total_price) as total_sales
-                    FROM sales s
-                    JOIN items i ON s.item_id = i.id
-                    WHERE DATE(s.sale_date) = DATE(?)
-                    GROUP BY i.name
-                ''', (today,))
-                sales = cursor.fetchall()
-
-            if not sales:
-                QMessageBox.information(self, "Daily Report", "No sales recorded for today")
-                return
-
-            report_text = f"<h2>Daily Sales Report - {today}</h2><hr><ul>"
-            total_sales = 0
-
-            for item in sales:
-                report_text += f"<li>{item[0]}: {item[1]} units - ${item[2]:.2f}</li>"
-                total_sales += item[2]
+    def _format_sales_summary(self, sales):
+        """Report body for (name, quantity, cents) rows"""
+        html = ""
+        total_sales = 0
+        for item in sales:
+            html += f"<li>{item[0]}: {item[1]} units - {format_money(item[2])}</li>"
+            total_sales += item[2]
 
-            report_text += f"</ul><hr><p><strong>Total Sales:</strong> ${total_sales:.2f}<br>"
-            report_text += f"<strong>Total Sales (LBP):</strong> {int(total_sales * 90000):,}</p>"
+        html += f"</ul><hr><p><strong>Total Sales:</strong> {format_money(total_sales)}<br>"
+        html += f"<strong>Total Sales (LBP):</strong> {format_lbp(total_sales)}</p>"
+        return html
 
-            self._show_report_dialog("Daily Report", report_text)
-
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to generate daily report: {str(e)}")
+    def _generate_daily_report(self):
+        today = datetime.now().date()
+        self.db_runner.submit('daily_report', self.reporting.daily, today,
+                              on_result=lambda sales: self._show_sales_report(
+                                  "Daily Report", f"Daily Sales Report - {today}",
+                                  "No sales recorded for today", sales),
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to generate daily report: {str(e)}"))
 
     def _generate_monthly_report(self):
         today = datetime.now()
-        first_day = today.replace(day=1)
-
-        try:
-            with self.db.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT i.name, SUM(s.quantity) as total_quantity, SUM(s.total_price) as total_sales
-                    FROM sales s
-                    JOIN items i ON s.item_id = i.id
-                    WHERE DATE(s.sale_date) >= DATE(?)
-                    GROUP BY i.name
-                ''', (first_day,))
-                sales = cursor.fetchall()
-
-            if not sales:
-                QMessageBox.information(self, "Monthly Report", "No sales recorded for this month")
-                return
-
-            report_text = f"<h2>Monthly Sales Report - {today.strftime('%B %Y')}</h2><hr><ul>"
-            total_sales = 0
-
-            for item in sales:
-                report_text += f"<li>{item[0]}: {item[1]} units - ${item[2]:.2f}</li>"
-                total_sales += item[2]
-
-            report_text += f"</ul><hr><p><strong>Total Sales:</strong> ${total_sales:.2f}<br>"
-            report_text += f"<strong>Total Sales (LBP):</strong> {int(total_sales * 90000):,}</p>"
+        self.db_runner.submit('monthly_report', self.reporting.monthly, today.date(),
+                              on_result=lambda sales: self._show_sales_report(
+                                  "Monthly Report", f"Monthly Sales Report - {today.strftime('%B %Y')}",
+                                  "No sales recorded for this month", sales),
+                              on_error=lambda e: QMessageBox.warning(self, "Error", f"Failed to generate monthly report: {str(e)}"))
+
+    def _show_sales_report(self, title, heading, empty_message, sales):
+        if not sales:
+            QMessageBox.information(self, title, empty_message)
+            return
 
-            self._show_report_dialog("Monthly Report", report_text)
+        report_text = f"<h2>{heading}</h2><hr><ul>"
+        report_text += self._format_sales_summary(sales)
+        self._show_report_dialog(title, report_text)
 
-        except Exception as e:
-            QMessageBox.warning(self, "Error", f"Failed to generate monthly report: {str(e)}")
+    def _show_query_profile(self):
+        profile = self.db.query_profile()
+        if profile is None:
+            return
+        html = "<h2>Query Profile</h2><table cellspacing='4'>"
+        html += "<tr><th>Total ms</th><th>Calls</th><th>Rows</th><th>Max ms</th><th>Caller</th><th>Statement</th></tr>"
+        for stats in profile['statements']:
+            caller = next(iter(stats['callers']), '')
+            html += (f"<tr><td>{stats['total_ms']:.1f}</td><td>{stats['calls']}</td><td>{stats['rows']}</td>"
+                     f"<td>{stats['max_ms']:.1f}</td><td>{escape(caller)}</td>"
+                     f"<td>{escape(stats['sql'][:120])}</td></tr>")
+        html += "</table>"
+        if profile['slow_queries']:
+            html += f"<h3>Slow queries (over {self.db.profile.slow_ms} ms)</h3><ul>"
+            for entry in list(profile['slow_queries'])[-10:]:
+                html += (f"<li>{entry['time']} {entry['elapsed_ms']:.1f} ms in {escape(entry['caller'] or '')}: "
+                         f"{escape(entry['sql'][:120])}<br><i>{escape('; '.join(entry['plan']))}</i></li>")
+            html += "</ul>"
+        self._show_report_dialog("Query Profile", html)
 
 if __name__ == '__main__':
+    slow_query_ms = None
+    backup_minutes = None
+    server = server_token = None
+    terminal = 0
+    for arg in sys.argv:
+        if arg == '--profile':
+            slow_query_ms = 100
+        elif arg.startswith('--profile='):
+            slow_query_ms = float(arg.split('=', 1)[1])
+        elif arg.startswith('--backup-every='):
+            backup_minutes = float(arg.split('=', 1)[1])
+        elif arg.startswith('--server='):
+            server = arg.split('=', 1)[1]
+        elif arg.startswith('--server-token='):
+            server_token = arg.split('=', 1)[1]
+        elif arg.startswith('--terminal='):
+            terminal = int(arg.split('=', 1)[1])
+    offline_first = '--offline-first' in sys.argv
+    if offline_first and (not server or terminal < 1):
+        sys.exit("--offline-first needs --server=URL and --terminal=N, a number from 1 unique to this till")
+    startup = StartupTimer(echo='--startup-times' in sys.argv)
+    startup.mark('imports')
     enforce_license() 
+    startup.mark('license')
     app = QApplication(sys.argv)
-    window = BakeryApp()
+    startup.mark('qt')
+    window = BakeryApp(write_behind='--write-behind' in sys.argv, slow_query_ms=slow_query_ms,
+                       startup=startup, backup_minutes=backup_minutes, server=server,
+                       server_token=server_token, offline_first=offline_first, terminal=terminal)
     window.show()
+    startup.mark('window')
     sys.exit(app.exec())
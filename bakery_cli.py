@@ -0,0 +1,284 @@
+"""Run bakery jobs from the command line, without Qt or a display.
+
+    python bakery_cli.py report daily --date 2024-05-01
+    python bakery_cli.py items add "Croissant" 1.50 --image croissant.png
+    python bakery_cli.py items import spring-menu.csv --images photos/
+    python bakery_cli.py invoices search --from 2024-05-01 --item croissant
+    python bakery_cli.py import-sales old-pos-sales.csv
+    python bakery_cli.py archive --before 2024 --vacuum
+    python bakery_cli.py backup now
+    python bakery_cli.py rebuild-rollup
+
+Every command goes through the same services as the till, so it is safe to
+run on the back-office machine against the shared database.
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import date, datetime
+
+from bakery_core import (BackupManager, DatabaseManager, InvoiceSearch, InventoryService, InvoicingService,
+                         ReportingService, SalesImporter, INVOICE_SORT_COLUMNS, format_money)
+
+
+def _print_rows(rows, as_json, headers):
+    if as_json:
+        print(json.dumps([dict(zip(headers, row)) for row in rows], indent=2, default=str))
+        return
+    for row in rows:
+        print("\t".join(str(value) for value in row))
+
+
+def _print_report(heading, sales, as_json):
+    if as_json:
+        print(json.dumps({
+            'report': heading,
+            'items': [{'name': name, 'quantity': quantity, 'cents': cents}
+                      for name, quantity, cents in sales],
+            'total_cents': sum(cents for _, _, cents in sales),
+        }, indent=2))
+        return
+    print(heading)
+    for name, quantity, cents in sales:
+        print(f"  {name}: {quantity} units - {format_money(cents)}")
+    print(f"Total Sales: {format_money(sum(cents for _, _, cents in sales))}")
+
+
+def report(db, args):
+    reporting = ReportingService(db)
+    if args.period == 'daily':
+        day = date.fromisoformat(args.date) if args.date else date.today()
+        _print_report(f"Daily Sales Report - {day}", reporting.daily(day), args.json)
+    else:
+        day = datetime.strptime(args.month, '%Y-%m').date() if args.month else date.today()
+        _print_report(f"Monthly Sales Report - {day.strftime('%B %Y')}", reporting.monthly(day), args.json)
+
+
+def items(db, args):
+    inventory = InventoryService(db)
+    if args.action == 'list':
+        _print_rows(inventory.list_items(), args.json, ('id', 'name', 'price', 'image_hash'))
+    elif args.action == 'add':
+        image_data = None
+        if args.image:
+            with open(args.image, 'rb') as image_file:
+                image_data = image_file.read()
+        # Thumbnails are rendered by the till the first time it shows the item
+        print(inventory.add_item(args.name, args.price, image_data))
+    elif args.action == 'update':
+        item = inventory.get_item(args.id)
+        if item is None:
+            raise ValueError("Item not found")
+        inventory.update_item(args.id, item[1] if args.name is None else args.name,
+                              item[2] if args.price is None else args.price, item[3])
+    elif args.action == 'delete':
+        inventory.delete_item(args.id)
+    elif args.action == 'import':
+        # Thumbnails are left to the till here too, so no Qt is needed
+        added, updated = inventory.import_catalog(args.path, args.images, workers=args.workers)
+        print(f"{added} items added, {updated} updated")
+    else:
+        print(f"{inventory.export_catalog(args.path, args.images)} items exported")
+
+
+def invoices(db, args):
+    invoicing = InvoicingService(db)
+    if args.action == 'show':
+        invoice, lines = invoicing.details(args.id)
+        if invoice is None:
+            raise ValueError("Invoice not found")
+        number, created_at, total = invoice
+        if args.json:
+            print(json.dumps({
+                'number': number, 'created_at': created_at, 'total': total,
+                'lines': [{'name': name, 'quantity': quantity, 'total_price': total_price}
+                          for name, quantity, total_price in lines],
+            }, indent=2))
+            return
+        print(f"INV-{number:04d}  {created_at}")
+        for name, quantity, total_price in lines:
+            print(f"  {name} x{quantity}: ${total_price:.2f}")
+        print(f"Total: ${total:.2f}")
+        return
+
+    search = InvoiceSearch(
+        number=InvoiceSearch.parse_number(args.number or ''),
+        start=date.fromisoformat(args.start) if args.start else None,
+        end=date.fromisoformat(args.end) if args.end else None,
+        min_total=args.min_total,
+        max_total=args.max_total,
+        item=args.item,
+    )
+    rows = invoicing.page(datetime.min, None, args.limit, args.sort, not args.ascending, search)
+    _print_rows(rows, args.json, ('id', 'number', 'created_at', 'total_quantity', 'total'))
+
+
+def import_sales(db, args):
+    importer = SalesImporter(db, args.batch_lines, create_items=not args.known_items_only)
+    started = time.perf_counter()
+    
+    def progress(records, invoices):
+        rate = records / max(time.perf_counter() - started, 1e-9)
+        print(f"{records} records, {invoices} invoices ({rate:.0f} records/s)", file=sys.stderr)
+    
+    records, invoices = importer.run(args.path, args.source, defer_indexes=not args.keep_indexes,
+                                     progress=progress)
+    print(f"{records} records imported as {invoices} invoices")
+
+
+def archive(db, args):
+    for year, invoices in db.archive(args.before).items():
+        print(f"{year}: {invoices} invoices moved to sales_{year}.db")
+    pruned = db.prune_images()
+    if pruned:
+        print(f"{pruned} images no item uses any more removed")
+    if args.vacuum:
+        db.vacuum()
+    with db.get_connection() as conn:
+        for year, path, invoices in conn.execute('SELECT year, path, invoices FROM archives ORDER BY year'):
+            print(f"Archived {year}: {invoices} invoices in {path}")
+
+
+def backup(db, args):
+    backups = BackupManager(db, args.folder, args.keep)
+    if args.action == 'now':
+        started = time.perf_counter()
+        name = backups.snapshot()
+        print(f"Snapshot {name} taken and verified in {time.perf_counter() - started:.1f}s")
+    elif args.action == 'list':
+        for name in backups.snapshots():
+            manifest = backups.manifest(name)
+            print(f"{name}\t{manifest['created_at']}\t{len(manifest['archives'])} archives")
+    elif args.action == 'verify':
+        for name in [args.name] if args.name else backups.snapshots():
+            backups.verify(name)
+            print(f"{name}: ok")
+    elif args.action == 'restore':
+        undo = backups.restore(args.name)
+        print(f"Restored {args.name}; the previous state was saved as snapshot {undo}")
+    else:
+        backups.prune()
+
+
+def check_query_plans(db, args):
+    for name, details in db.check_query_plans().items():
+        print(f"{name}:\n  " + "\n  ".join(details))
+
+
+def rebuild_rollup(db, args):
+    mismatches = ReportingService(db).rebuild_rollup()
+    for day, item_id, expected, stored in mismatches:
+        print(f"{day} item {item_id}: expected {expected}, stored {stored}")
+    print(f"Sales rollup rebuilt, {len(mismatches)} rows corrected")
+    return 1 if mismatches else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='bakery.db')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_report = commands.add_parser('report', help='daily or monthly sales report')
+    parser_report.add_argument('period', choices=('daily', 'monthly'))
+    parser_report.add_argument('--date', help='YYYY-MM-DD, default today')
+    parser_report.add_argument('--month', help='YYYY-MM, default this month')
+    parser_report.add_argument('--json', action='store_true')
+    parser_report.set_defaults(handler=report)
+
+    parser_items = commands.add_parser('items', help='list and edit the item catalog')
+    item_actions = parser_items.add_subparsers(dest='action', required=True)
+    item_list = item_actions.add_parser('list')
+    item_list.add_argument('--json', action='store_true')
+    item_add = item_actions.add_parser('add')
+    item_add.add_argument('name')
+    item_add.add_argument('price', type=float)
+    item_add.add_argument('--image')
+    item_update = item_actions.add_parser('update')
+    item_update.add_argument('id', type=int)
+    item_update.add_argument('--name')
+    item_update.add_argument('--price', type=float)
+    item_delete = item_actions.add_parser('delete')
+    item_delete.add_argument('id', type=int)
+    item_import = item_actions.add_parser('import', help='add or update items from a CSV or JSON catalog')
+    item_import.add_argument('path')
+    item_import.add_argument('--images', help='folder image paths are relative to, default the catalog\'s')
+    item_import.add_argument('--workers', type=int, help='processes reading images')
+    item_export = item_actions.add_parser('export', help='write the catalog as CSV or JSON')
+    item_export.add_argument('path')
+    item_export.add_argument('--images', help='folder to save images in, default images/ next to the catalog')
+    parser_items.set_defaults(handler=items)
+
+    parser_invoices = commands.add_parser('invoices', help='search invoices and show their lines')
+    invoice_actions = parser_invoices.add_subparsers(dest='action', required=True)
+    invoice_search = invoice_actions.add_parser('search')
+    invoice_search.add_argument('--number')
+    invoice_search.add_argument('--from', dest='start', help='YYYY-MM-DD')
+    invoice_search.add_argument('--to', dest='end', help='YYYY-MM-DD')
+    invoice_search.add_argument('--min-total', type=float)
+    invoice_search.add_argument('--max-total', type=float)
+    invoice_search.add_argument('--item', help='item name or the start of one')
+    invoice_search.add_argument('--sort', choices=INVOICE_SORT_COLUMNS, default='created_at')
+    invoice_search.add_argument('--ascending', action='store_true')
+    invoice_search.add_argument('--limit', type=int, default=200)
+    invoice_search.add_argument('--json', action='store_true')
+    invoice_show = invoice_actions.add_parser('show')
+    invoice_show.add_argument('id', type=int)
+    invoice_show.add_argument('--json', action='store_true')
+    parser_invoices.set_defaults(handler=invoices)
+
+    parser_import = commands.add_parser('import-sales', help='load sales history from another till system')
+    parser_import.add_argument('path', help='CSV or JSON Lines export, one invoice line per record')
+    parser_import.add_argument('--source', help='name the checkpoint and invoice uids use, default the file name')
+    parser_import.add_argument('--batch-lines', type=int, default=100000, help='lines per transaction')
+    parser_import.add_argument('--keep-indexes', action='store_true',
+                               help='keep history indexes while importing, e.g. while the till is open')
+    parser_import.add_argument('--known-items-only', action='store_true',
+                               help='fail on item names not in the catalog instead of adding them')
+    parser_import.set_defaults(handler=import_sales)
+
+    parser_archive = commands.add_parser('archive', help='move past years of sales out to sales_YYYY.db files')
+    parser_archive.add_argument('--before', type=int, help='archive years before this one, default the current year')
+    parser_archive.add_argument('--vacuum', action='store_true', help='shrink the live file afterwards')
+    parser_archive.set_defaults(handler=archive)
+
+    parser_backup = commands.add_parser('backup', help='snapshot the live database, even while the till is open')
+    parser_backup.add_argument('--folder', help='where snapshots are kept, default bakery.db.backups')
+    parser_backup.add_argument('--keep', type=int, default=14, help='snapshots to keep')
+    backup_actions = parser_backup.add_subparsers(dest='action', required=True)
+    backup_actions.add_parser('now')
+    backup_actions.add_parser('list')
+    backup_actions.add_parser('verify').add_argument('name', nargs='?', help='default every snapshot')
+    backup_actions.add_parser('restore', help='close the till first').add_argument('name')
+    backup_actions.add_parser('prune')
+    parser_backup.set_defaults(handler=backup)
+
+    commands.add_parser('check-query-plans', help='fail if a planned query scans a whole table'
+                        ).set_defaults(handler=check_query_plans)
+    commands.add_parser('rebuild-rollup', help='recompute the report rollup from raw sales'
+                        ).set_defaults(handler=rebuild_rollup)
+    commands.add_parser('benchmark', help='time the hot query paths (see benchmark.py --help)',
+                        add_help=False)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['benchmark']:
+        import benchmark
+        return benchmark.main(argv[1:])
+
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    db = DatabaseManager(args.database)
+    try:
+        return args.handler(db, args)
+    except (ValueError, RuntimeError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2380 @@
+"""Bakery business logic with no Qt dependency: money and cart types, the
+database layer and the services the till, the CLI and the benchmark share.
+"""
+import sys
+import time
+import sqlite3
+from datetime import date, datetime, timedelta
+import base64
+import bisect
+import csv
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+def to_cents(amount):
+    return int(round(amount * 100))
+
+def format_money(cents):
+    return f"${cents / 100:.2f}"
+
+def format_lbp(cents):
+    # 90,000 LBP to the dollar
+    return f"{cents * 900:,}"
+
+
+class CartLine:
+    """One item in the sale being rung up; prices are integer cents"""
+    __slots__ = ('item_id', 'name', 'unit_price', 'quantity')
+    
+    def __init__(self, item_id, name, unit_price, quantity=0):
+        self.item_id = item_id
+        self.name = name
+        self.unit_price = unit_price
+        self.quantity = quantity
+    
+    @property
+    def total(self):
+        return self.unit_price * self.quantity
+
+
+class Cart:
+    """The current sale, keyed by item id in the order items were first added.
+    The running total is kept up to date on every change."""
+    def __init__(self):
+        self.lines = {}
+        self.total = 0
+    
+    def __len__(self):
+        return len(self.lines)
+    
+    def __iter__(self):
+        return iter(self.lines.values())
+    
+    def add(self, item_id, name, unit_price, quantity=1):
+        """Add quantity of an item, starting a new line if needed; returns the line"""
+        line = self.lines.get(item_id)
+        if line is None:
+            line = self.lines[item_id] = CartLine(item_id, name, unit_price)
+        line.quantity += quantity
+        self.total += line.unit_price * quantity
+        return line
+    
+    def remove(self, item_id):
+        line = self.lines.pop(item_id, None)
+        if line is not None:
+            self.total -= line.total
+        return line
+    
+    def clear(self):
+        self.lines.clear()
+        self.total = 0
+
+
+class InvoiceSearch:
+    """Criteria for searching the whole invoice history; None means any.
+    Dates are inclusive, totals are in dollars as stored on invoices."""
+    __slots__ = ('number', 'start', 'end', 'min_total', 'max_total', 'item')
+    
+    def __init__(self, number=None, start=None, end=None, min_total=None, max_total=None, item=None):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.min_total = min_total
+        self.max_total = max_total
+        self.item = item
+    
+    def __bool__(self):
+        return any(getattr(self, name) not in (None, '') for name in self.__slots__)
+    
+    @staticmethod
+    def parse_number(text):
+        """Invoice number from "INV-0012", "0012" or "12"; None if text has no digits"""
+        digits = ''.join(ch for ch in text if ch.isdigit())
+        return int(digits) if digits else None
+    
+    def item_match(self):
+        """FTS5 query matching item names that start with each typed word"""
+        words = self.item.split()
+        return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+# Thumbnail sizes rendered at upload time: inventory table cell, sales grid button
+CELL_THUMBNAIL = (50, 50)
+BUTTON_THUMBNAIL = (112, 92)
+THUMBNAIL_SIZES = (CELL_THUMBNAIL, BUTTON_THUMBNAIL)
+
+
+ITEM_LIST_SQL = 'SELECT id, name, price, image_hash FROM items'
+
+ITEM_SQL = 'SELECT id, name, price, image_hash FROM items WHERE id = ?'
+
+THUMBNAIL_SQL = 'SELECT data FROM image_thumbnails WHERE hash = ? AND width = ? AND height = ?'
+
+# Invoice history can be ordered by any of these columns. Each has an index,
+# and since every index ends with the rowid it also orders by (column, id)
+INVOICE_SORT_COLUMNS = ('number', 'created_at', 'total_quantity', 'total')
+
+# One page of invoice history per (column, descending). Paging continues from
+# the last (column, id) seen instead of using OFFSET, so every page is an
+# index seek
+INVOICE_HISTORY_SQL = {
+    (column, descending): f'''
+    SELECT id, number, created_at, total_quantity, total
+    FROM invoices
+    WHERE created_at > ? AND ({column}, id) {'<' if descending else '>'} (?, ?)
+    ORDER BY {column} {'DESC' if descending else 'ASC'}, id {'DESC' if descending else 'ASC'}
+    LIMIT ?
+'''
+    for column in INVOICE_SORT_COLUMNS for descending in (True, False)
+}
+
+# How many sales lines, up to a limit, are for items matching an FTS query
+ITEM_SALES_ESTIMATE_SQL = '''
+    SELECT COUNT(*) FROM (
+        SELECT 1 FROM sales
+        WHERE item_id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?)
+        LIMIT ?
+    )
+'''
+
+INVOICE_SQL = 'SELECT number, created_at, total FROM invoices WHERE id = ?'
+
+INVOICE_DETAILS_SQL = '''
+    SELECT i.name, s.quantity, s.total_price
+    FROM sales s
+    JOIN items i ON s.item_id = i.id
+    WHERE s.invoice_id = ?
+    ORDER BY s.id
+'''
+
+# Per-item totals for a half-open [start, end) range of days, read from the
+# rollup that checkout keeps up to date; revenue is in cents
+SALES_SUMMARY_SQL = '''
+    SELECT i.name, SUM(r.quantity) as total_quantity, SUM(r.revenue_cents) as total_sales
+    FROM sales_rollup r
+    JOIN items i ON r.item_id = i.id
+    WHERE r.day >= ? AND r.day < ?
+    GROUP BY i.name
+'''
+
+ROLLUP_UPSERT_SQL = '''
+    INSERT INTO sales_rollup (day, item_id, quantity, revenue_cents) VALUES (?, ?, ?, ?)
+    ON CONFLICT (day, item_id) DO UPDATE SET
+        quantity = quantity + excluded.quantity,
+        revenue_cents = revenue_cents + excluded.revenue_cents
+'''
+
+# Invoice ids are never reused, even once older invoices have moved out to
+# an archive: a new id is one past both the live and the archived ones
+INVOICE_INSERT_SQL = '''
+    INSERT INTO invoices (id, uid, number, created_at, item_count, total_quantity, total)
+    VALUES (MAX(IFNULL((SELECT MAX(id) FROM invoices), 0),
+                IFNULL((SELECT MAX(last_invoice_id) FROM archives), 0)) + 1,
+            ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (uid) DO NOTHING
+    RETURNING id
+'''
+
+# What sales_rollup should contain, aggregated from raw sales
+ROLLUP_FROM_SALES_SQL = '''
+    SELECT substr(sale_date, 1, 10) as day, item_id,
+           SUM(quantity) as quantity,
+           SUM(CAST(ROUND(total_price * 100) AS INTEGER)) as revenue_cents
+    FROM sales
+    WHERE sale_date IS NOT NULL AND item_id IS NOT NULL
+    GROUP BY day, item_id
+'''
+
+
+# Tables whose rows move to a sales_YYYY.db archive a year at a time
+ARCHIVED_TABLES = ('invoices', 'sales', 'sales_rollup')
+
+
+def _in_schema(sql, schema):
+    """sql with the archived tables it reads qualified by schema, so the same
+    query runs against the live file or an attached archive"""
+    if schema == 'main':
+        return sql
+    return re.sub(r'\b(FROM|JOIN)\s+(invoices|sales_rollup|sales)\b', rf'\1 {schema}.\2', sql)
+
+
+def _is_table_scan(detail):
+    """Whether an EXPLAIN QUERY PLAN line reads a whole table. Walking the
+    rows of a subquery, or an FTS5 MATCH (idxStr with an M), does not."""
+    if not detail.startswith('SCAN ') or detail.startswith(('SCAN (subquery', 'SCAN SUBQUERY')):
+        return False
+    virtual = re.search(r'VIRTUAL TABLE INDEX \d+:(\S*)', detail)
+    return virtual is None or 'M' not in virtual.group(1)
+
+
+class _StatementStats:
+    """Totals for one SQL text across every call"""
+    __slots__ = ('sql', 'calls', 'rows', 'total_ms', 'max_ms', 'histogram', 'callers')
+    
+    def __init__(self, sql, buckets):
+        self.sql = sql
+        self.calls = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (buckets + 1)
+        self.callers = {}
+
+
+class _StatementCall:
+    """One execution of a statement; rows fetched later add to its time"""
+    __slots__ = ('profile', 'stats', 'connection', 'sql', 'parameters', 'caller', 'elapsed_ms')
+    
+    def __init__(self, profile, stats, connection, sql, parameters, caller):
+        self.profile = profile
+        self.stats = stats
+        self.connection = connection
+        self.sql = sql
+        self.parameters = parameters
+        self.caller = caller
+        self.elapsed_ms = None
+    
+    def fetched(self, elapsed_ms, rows):
+        self.profile._add(self, elapsed_ms, rows)
+
+
+class QueryProfile:
+    """Per-statement timings collected by tracked connections while
+    profiling is on.
+
+    Each statement's time includes fetching its rows. Calls are attributed
+    to the code that asked for them: the method that submitted the work to
+    a QueryRunner, otherwise the first caller outside this module.
+    Statements slower than slow_ms go to the slow-query log together with
+    their query plan, in memory and, given slow_log, appended to that file
+    as JSON lines.
+    """
+    BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+    
+    def __init__(self, slow_ms=100, slow_log=None, keep_slow=200):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self.slow_queries = deque(maxlen=keep_slow)
+        self.statements = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    @staticmethod
+    def caller_name(frame):
+        """Qualified name of the first function above frame that is not part
+        of this module"""
+        inner = None
+        while frame is not None:
+            module = frame.f_globals.get('__name__')
+            name = getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)
+            if module != __name__:
+                if module == 'threading' and inner:
+                    # A background thread of this module, such as the journal's
+                    return inner
+                return f"{module}.{name}"
+            inner = name
+            frame = frame.f_back
+        return inner
+    
+    @contextmanager
+    def calling(self, caller):
+        """Attribute statements run in this block on this thread to caller"""
+        previous = getattr(self._local, 'caller', None)
+        self._local.caller = caller
+        try:
+            yield
+        finally:
+            self._local.caller = previous
+    
+    def executed(self, connection, sql, parameters, elapsed_ms, rows):
+        caller = getattr(self._local, 'caller', None) or self.caller_name(sys._getframe(1))
+        with self._lock:
+            stats = self.statements.get(sql)
+            if stats is None:
+                stats = self.statements[sql] = _StatementStats(sql, len(self.BUCKETS_MS))
+            stats.calls += 1
+            stats.callers[caller] = stats.callers.get(caller, 0) + 1
+        call = _StatementCall(self, stats, connection, sql, parameters, caller)
+        self._add(call, elapsed_ms, rows)
+        return call
+    
+    def _add(self, call, elapsed_ms, rows):
+        before = call.elapsed_ms
+        after = elapsed_ms if before is None else before + elapsed_ms
+        call.elapsed_ms = after
+        stats = call.stats
+        with self._lock:
+            stats.rows += rows
+            stats.total_ms += elapsed_ms
+            stats.max_ms = max(stats.max_ms, after)
+            if before is not None:
+                stats.histogram[bisect.bisect_left(self.BUCKETS_MS, before)] -= 1
+            stats.histogram[bisect.bisect_left(self.BUCKETS_MS, after)] += 1
+        if (before or 0) <= self.slow_ms < after:
+            self._log_slow(call)
+    
+    def _log_slow(self, call):
+        try:
+            # A plain cursor, so the plan lookup is not profiled itself
+            plan = [row[3] for row in sqlite3.Cursor(call.connection).execute(
+                'EXPLAIN QUERY PLAN ' + call.sql, call.parameters or ())]
+        except sqlite3.Error:
+            plan = []
+        entry = {
+            'time': datetime.now().isoformat(sep=' ', timespec='milliseconds'),
+            'elapsed_ms': round(call.elapsed_ms, 3),
+            'caller': call.caller,
+            'sql': ' '.join(call.sql.split()),
+            'parameters': repr(call.parameters)[:200],
+            'plan': plan,
+        }
+        self.slow_queries.append(entry)
+        if self.slow_log:
+            with self._lock, open(self.slow_log, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+    
+    def top(self, n=20):
+        """The n statements with the most total time, busiest first"""
+        with self._lock:
+            ranked = sorted(self.statements.values(), key=lambda stats: stats.total_ms, reverse=True)[:n]
+            labels = [f"<={bound}ms" for bound in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+            return [{
+                'sql': ' '.join(stats.sql.split()),
+                'calls': stats.calls,
+                'rows': stats.rows,
+                'total_ms': round(stats.total_ms, 3),
+                'mean_ms': round(stats.total_ms / stats.calls, 3),
+                'max_ms': round(stats.max_ms, 3),
+                'histogram': {label: count for label, count in zip(labels, stats.histogram) if count},
+                'callers': dict(sorted(stats.callers.items(), key=lambda item: -item[1])),
+            } for stats in ranked]
+
+
+class _TrackedCursor(sqlite3.Cursor):
+    """Cursor that reports every statement to its connection and, while the
+    connection is profiled, times it through to its last fetched row"""
+    _call = None
+    
+    def execute(self, sql, parameters=()):
+        profile = self.connection._note_statement(sql)
+        if profile is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        self._call = profile.executed(self.connection, sql, parameters,
+                                      (time.perf_counter() - started) * 1000, max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        profile = self.connection._note_statement(sql)
+        if profile is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._call = profile.executed(self.connection, sql, None,
+                                      (time.perf_counter() - started) * 1000, max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        if self._call is None:
+            return super().fetchone()
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._call.fetched((time.perf_counter() - started) * 1000, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        if self._call is None:
+            return super().fetchmany(size)
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._call.fetched((time.perf_counter() - started) * 1000, len(rows))
+        return rows
+
+    def fetchall(self):
+        if self._call is None:
+            return super().fetchall()
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._call.fetched((time.perf_counter() - started) * 1000, len(rows))
+        return rows
+
+    def __iter__(self):
+        if self._call is None:
+            return self
+        return self._profiled_rows()
+
+    def _profiled_rows(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+
+class _TrackedConnection(sqlite3.Connection):
+    """Connection that counts statements and prepared-statement cache reuse,
+    and hands them to a QueryProfile while profile is set.
+
+    sqlite3 keeps an LRU cache of compiled statements keyed by SQL text; the
+    ``_seen`` mirror uses the same size so hits here are cache hits there.
+    """
+    def __init__(self, *args, cached_statements=128, **kwargs):
+        super().__init__(*args, cached_statements=cached_statements, **kwargs)
+        self.cache_size = cached_statements
+        self.statements = 0
+        self.cache_hits = 0
+        self.profile = None
+        self._seen = OrderedDict()
+        # Archive schemas ATTACHed to this connection, least recently used first
+        self.archives = OrderedDict()
+
+    def cursor(self, factory=_TrackedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def _note_statement(self, sql):
+        self.statements += 1
+        if sql in self._seen:
+            self.cache_hits += 1
+            self._seen.move_to_end(sql)
+        else:
+            self._seen[sql] = None
+            if len(self._seen) > self.cache_size:
+                self._seen.popitem(last=False)
+        return self.profile
+
+
+class LatencyTracker:
+    """Recent latency samples in milliseconds, measured against a target"""
+    def __init__(self, target_ms, window=1000):
+        self.target_ms = target_ms
+        self.count = 0
+        self.over_target = 0
+        self._samples = deque(maxlen=window)
+    
+    def record(self, elapsed_ms):
+        self.count += 1
+        if elapsed_ms > self.target_ms:
+            self.over_target += 1
+        self._samples.append(elapsed_ms)
+    
+    def summary(self):
+        samples = sorted(self._samples)
+        if not samples:
+            return {'count': 0, 'target_ms': self.target_ms}
+        return {
+            'count': self.count,
+            'target_ms': self.target_ms,
+            'over_target': self.over_target,
+            'p50_ms': samples[len(samples) // 2],
+            'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'max_ms': samples[-1],
+        }
+
+
+class InvoiceNumberAllocator:
+    """Per-day invoice numbers from daily_invoice_count, safe across tills
+    sharing one database file.
+
+    With a block size of 1 each number is claimed inside the checkout
+    transaction by one atomic UPSERT, so numbers stay gap-free. A larger
+    block makes the till claim that many numbers at once in a short
+    transaction of its own and hand them out locally. That means far fewer
+    writes to the shared file, but numbers from different tills interleave
+    and unused ones are skipped. A write-behind till claims its next block
+    from the journal's background thread before the current one runs out,
+    so a checkout only claims one itself when that thread has not got
+    ahead, as with the first sale after midnight.
+
+    A till that numbers its own sales while offline is given a terminal
+    number and counts in its own range: terminal 2's invoices are 20001,
+    20002 and so on, which no other till can hand out.
+    """
+    TERMINAL_NUMBERS = 10000
+    RESERVE_SQL = '''
+        INSERT INTO daily_invoice_count (date, count) VALUES (?, ?)
+        ON CONFLICT (date) DO UPDATE SET count = count + excluded.count
+        RETURNING count
+    '''
+    
+    def __init__(self, block_size=1, terminal=0):
+        self.block_size = block_size
+        self.base = terminal * self.TERMINAL_NUMBERS
+        self._lock = threading.Lock()
+        self._day = None
+        self._next = 0
+        self._end = 0
+        # (day, first number) of a block claimed ahead of need
+        self._spare = None
+    
+    def reserve(self, cursor, day, size=1):
+        """Claim size consecutive numbers for day; returns the first"""
+        last = cursor.execute(self.RESERVE_SQL, (day, size)).fetchone()[0]
+        return self.base + last - size + 1
+    
+    def take_reserved(self, db, day):
+        """Next number from this till's block, or None when numbers are
+        claimed one at a time inside the checkout transaction"""
+        if self.block_size <= 1:
+            return None
+        with self._lock:
+            if self._day != day or self._next >= self._end:
+                if self.has_spare(day):
+                    self._next = self._spare[1]
+                    self._spare = None
+                else:
+                    with db.get_connection() as conn:
+                        self._next = self.reserve(conn.cursor(), day, self.block_size)
+                        conn.commit()
+                self._day = day
+                self._end = self._next + self.block_size
+            number = self._next
+            self._next += 1
+            return number
+    
+    def has_spare(self, day):
+        return self._spare is not None and self._spare[0] == day
+    
+    def reserve_ahead(self, db, day):
+        """Claim the block after the current one unless it is already
+        claimed; called off the checkout path"""
+        if self.block_size <= 1:
+            return
+        with self._lock:
+            if self.has_spare(day):
+                return
+        with db.get_connection() as conn:
+            first = self.reserve(conn.cursor(), day, self.block_size)
+            conn.commit()
+        with self._lock:
+            # A block claimed meanwhile for the same day is skipped, like
+            # any unused number
+            self._spare = (day, first)
+
+
+class SalesJournal:
+    """Append-only file of checkouts that have been acknowledged but not yet
+    written to the sales tables.
+
+    append() writes one JSON line and fsyncs it, which is all a till waits
+    for. A background thread hands the pending entries to apply() in
+    batches; once everything in the file has been applied the file is
+    truncated. Entries carry a uid and applying one twice is a no-op, so a
+    crash between apply and truncate only means replaying a few entries.
+
+    The till writing the journal holds an exclusive lock on it while open.
+    Whatever a crashed run left in it is applied when the next one takes
+    the lock, and nobody else ever reads or removes it. prepare, if given,
+    is called on the background thread before every flush.
+    """
+    
+    def __init__(self, path, apply, flush_interval=0.5, batch_size=200, prepare=None):
+        self.path = path
+        self.apply = apply
+        self.prepare = prepare
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.batches = 0
+        self.errors = 0
+        self.last_error = None
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'ab')
+        if not _lock_file(self._file):
+            self._file.close()
+            raise RuntimeError(f"Sales journal {path} is in use by another till")
+        # Sales a previous run acknowledged but had not written when it stopped
+        leftovers = self.read(path)
+        if leftovers:
+            apply(leftovers)
+        self._file.truncate(0)
+        os.fsync(self._file.fileno())
+        self._thread = threading.Thread(target=self._run, name='sales-journal', daemon=True)
+        self._thread.start()
+    
+    @staticmethod
+    def read(path):
+        """Entries left in a journal file; a torn last line from a crash
+        mid-write is dropped, since that sale was never acknowledged"""
+        entries = []
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return entries
+        with f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+        return entries
+    
+    def append(self, entry):
+        data = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+        with self._lock:
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending.append(entry)
+            pending = len(self._pending)
+        if pending >= self.batch_size:
+            self._wakeup.set()
+    
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+    
+    def wake(self):
+        """Run the background thread now rather than at the next interval"""
+        self._wakeup.set()
+    
+    def flush(self):
+        """Apply every pending entry; on failure they stay queued and on disk"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if batch:
+                try:
+                    self.apply(batch)
+                except Exception as e:
+                    with self._lock:
+                        self._pending[:0] = batch
+                    self.errors += 1
+                    self.last_error = e
+                    return False
+                self.batches += 1
+            with self._lock:
+                if not self._pending:
+                    self._file.truncate(0)
+                    os.fsync(self._file.fileno())
+        return True
+    
+    def _run(self):
+        while not self._stopping:
+            if self.prepare is not None:
+                try:
+                    self.prepare()
+                except Exception as e:
+                    self.errors += 1
+                    self.last_error = e
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+    
+    def close(self):
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        # Closing the file releases the lock
+        self._file.close()
+
+
+def _lock_file(f):
+    """Take an exclusive lock on an open file without waiting; False if
+    another process holds it"""
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def local_data_dir():
+    """This machine's own folder for bakery files, never a shared drive"""
+    base = (os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_STATE_HOME')
+            or os.path.join(os.path.expanduser('~'), '.local', 'state'))
+    return os.path.join(base, 'bakery')
+
+
+def default_journal_path(db_name):
+    """Where a write-behind till keeps the sales journal for db_name: on
+    local disk, one file per database"""
+    path = os.path.abspath(db_name)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(local_data_dir(), f"{os.path.basename(path)}-{digest}.journal")
+
+
+class DatabaseManager:
+    """Centralized database management.
+
+    Each thread gets one long-lived connection, opened on first use and
+    tuned once, instead of a fresh connect per query.
+    """
+    STATEMENT_CACHE_SIZE = 256
+    PRAGMAS = (
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -16000),  # 16 MB
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 5000),
+    )
+
+    # Queries that must be answered through an index, with sample parameters.
+    # Those reading archived tables are checked against an archive as well.
+    PLANNED_QUERIES = {
+        'item': (ITEM_SQL, (1,)),
+        'thumbnail': (THUMBNAIL_SQL, ('', 50, 50)),
+        'invoice': (INVOICE_SQL, (1,)),
+        'invoice_details': (INVOICE_DETAILS_SQL, (1,)),
+        'sales_summary': (SALES_SUMMARY_SQL, ('2000-01-01', '2000-01-02')),
+        'item_sales_estimate': (ITEM_SALES_ESTIMATE_SQL, ('"bread"*', 5000)),
+        **{f"invoice_history_{column}_{'desc' if descending else 'asc'}": (sql, ('2000-01-01', 0, 0, 200))
+           for (column, descending), sql in INVOICE_HISTORY_SQL.items()},
+    }
+
+    # Checkout is what customers wait for at the till
+    CHECKOUT_TARGET_MS = 50
+    # Write-behind checkouts must not touch the database for a number
+    WRITE_BEHIND_BLOCK_SIZE = 20
+    
+    def __init__(self, db_name='bakery.db', journal_mode='WAL', invoice_block_size=1,
+                 write_behind=False, sales_journal=None, terminal=0):
+        self.db_name = db_name
+        self.journal_mode = journal_mode
+        if write_behind and invoice_block_size <= 1:
+            invoice_block_size = self.WRITE_BEHIND_BLOCK_SIZE
+        self.invoice_numbers = InvoiceNumberAllocator(invoice_block_size, terminal)
+        self.checkout_latency = LatencyTracker(self.CHECKOUT_TARGET_MS)
+        self.connects = 0
+        self.profile = None
+        # Keyed by thread id rather than threading.local: Qt pool threads get
+        # a fresh Python thread state for every task they run
+        self._connections = {}
+        self._depth = {}
+        self._lock = threading.Lock()
+        self._init_db()
+        # The sales journal belongs to this till, so it sits on local disk
+        # even when the database file is shared. Only a write-behind till
+        # opens it; the CLI, the server and other tills leave it alone.
+        self.sales_journal_path = sales_journal or default_journal_path(db_name)
+        self.sales_journal = None
+        if write_behind:
+            self.sales_journal = SalesJournal(
+                self.sales_journal_path, self._apply_journaled_sales,
+                prepare=lambda: self.invoice_numbers.reserve_ahead(self, datetime.now().strftime('%Y-%m-%d')))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_name, factory=_TrackedConnection,
+                               cached_statements=self.STATEMENT_CACHE_SIZE,
+                               check_same_thread=False)
+        conn.execute(f'PRAGMA journal_mode = {self.journal_mode}')
+        for pragma, value in self.PRAGMAS:
+            conn.execute(f'PRAGMA {pragma} = {value}')
+        conn.profile = self.profile
+        with self._lock:
+            self.connects += 1
+            self._connections[threading.get_ident()] = conn
+        return conn
+
+    @contextmanager
+    def get_connection(self):
+        """Context manager for the calling thread's shared connection"""
+        thread_id = threading.get_ident()
+        conn = self._connections.get(thread_id)
+        if conn is None:
+            conn = self._connect()
+        depth = self._depth.get(thread_id, 0)
+        self._depth[thread_id] = depth + 1
+        try:
+            yield conn
+        finally:
+            self._depth[thread_id] = depth
+            # Leaving the outermost block discards uncommitted work, just as
+            # closing a per-query connection used to
+            if depth == 0 and conn.in_transaction:
+                conn.rollback()
+
+    def stats(self):
+        """Connection and prepared-statement reuse counters"""
+        with self._lock:
+            connections = list(self._connections.values())
+            connects = self.connects
+        statements = sum(conn.statements for conn in connections)
+        cache_hits = sum(conn.cache_hits for conn in connections)
+        return {
+            'connects': connects,
+            'open_connections': len(connections),
+            'statements': statements,
+            'statement_cache_hits': cache_hits,
+            'statement_reuse': cache_hits / statements if statements else 0.0,
+            'checkout': self.checkout_latency.summary(),
+            'journal_pending': self.sales_journal.pending() if self.sales_journal else 0,
+        }
+
+    def start_profiling(self, slow_ms=100, slow_log=None):
+        """Time every statement from now on; see QueryProfile"""
+        self._set_profile(QueryProfile(slow_ms, slow_log))
+        return self.profile
+    
+    def stop_profiling(self):
+        self._set_profile(None)
+    
+    def _set_profile(self, profile):
+        with self._lock:
+            self.profile = profile
+            for conn in self._connections.values():
+                conn.profile = profile
+    
+    def query_profile(self, top=20):
+        """The busiest statements and the slow-query log, or None when
+        profiling is off"""
+        profile = self.profile
+        if profile is None:
+            return None
+        return {'statements': profile.top(top), 'slow_queries': list(profile.slow_queries)}
+    
+    def release_connection(self):
+        """Close the calling thread's connection, for a thread about to end;
+        its id may be reused by a new thread"""
+        thread_id = threading.get_ident()
+        with self._lock:
+            conn = self._connections.pop(thread_id, None)
+        self._depth.pop(thread_id, None)
+        if conn is not None:
+            conn.close()
+    
+    def close(self):
+        """Write out journaled sales and close every connection owned by this
+        manager"""
+        if self.sales_journal is not None:
+            self.sales_journal.close()
+            self.sales_journal = None
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for conn in connections.values():
+            conn.close()
+    
+    # Secondary indexes on the sales history. A bulk import drops those it
+    # does not read while it runs and builds them once at the end.
+    HISTORY_INDEXES = {
+        'idx_sales_sale_date': 'CREATE INDEX IF NOT EXISTS idx_sales_sale_date ON sales (sale_date)',
+        # Finds the invoices containing an item without reading sales rows
+        'idx_sales_item_invoice':
+            'CREATE INDEX IF NOT EXISTS idx_sales_item_invoice ON sales (item_id, invoice_id)',
+        'idx_sales_invoice_id': 'CREATE INDEX IF NOT EXISTS idx_sales_invoice_id ON sales (invoice_id)',
+        'idx_invoices_created_at':
+            'CREATE INDEX IF NOT EXISTS idx_invoices_created_at ON invoices (created_at)',
+        'idx_invoices_number': 'CREATE INDEX IF NOT EXISTS idx_invoices_number ON invoices (number)',
+        'idx_invoices_total_quantity':
+            'CREATE INDEX IF NOT EXISTS idx_invoices_total_quantity ON invoices (total_quantity)',
+        'idx_invoices_total': 'CREATE INDEX IF NOT EXISTS idx_invoices_total ON invoices (total)',
+    }
+    # Kept during an import, which numbers invoices by day
+    IMPORT_INDEXES = ('idx_invoices_created_at',)
+    
+    def _init_db(self):
+        """Initialize database tables"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            
+            # AUTOINCREMENT: a deleted item's id is never given to a new one,
+            # so sales an offline-first till made before the delete reached
+            # it are still booked to the item they were for
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    price REAL NOT NULL,
+                    image_hash TEXT,
+                    version INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            # Image bytes live outside the items row, keyed by content hash,
+            # so listing the catalog never reads them
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS images (
+                    hash TEXT PRIMARY KEY,
+                    data BLOB NOT NULL
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS image_thumbnails (
+                    hash TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (hash, width, height)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS invoices (
+                    id INTEGER PRIMARY KEY,
+                    uid TEXT,
+                    number INTEGER NOT NULL,
+                    created_at DATETIME NOT NULL,
+                    item_count INTEGER NOT NULL DEFAULT 0,
+                    total_quantity INTEGER NOT NULL DEFAULT 0,
+                    total REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sales (
+                    id INTEGER PRIMARY KEY,
+                    item_id INTEGER,
+                    quantity INTEGER,
+                    total_price REAL,
+                    sale_date DATETIME,
+                    invoice_id INTEGER,
+                    FOREIGN KEY (item_id) REFERENCES items (id),
+                    FOREIGN KEY (invoice_id) REFERENCES invoices (id)
+                )
+            ''')
+            
+            # Per day and item totals, so reports never aggregate raw sales
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sales_rollup (
+                    day TEXT NOT NULL,
+                    item_id INTEGER NOT NULL,
+                    quantity INTEGER NOT NULL DEFAULT 0,
+                    revenue_cents INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, item_id)
+                ) WITHOUT ROWID
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_invoice_count (
+                    date TEXT PRIMARY KEY,
+                    count INTEGER DEFAULT 0
+                )
+            ''')
+            
+            # Years moved out to their own sales_YYYY.db file, with the range
+            # of invoice ids each holds
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS archives (
+                    year INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    first_invoice_id INTEGER,
+                    last_invoice_id INTEGER,
+                    invoices INTEGER NOT NULL DEFAULT 0,
+                    archived_at DATETIME
+                )
+            ''')
+            
+            # How far each bulk sales import has got, so it can resume
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS import_checkpoints (
+                    source TEXT PRIMARY KEY,
+                    records INTEGER NOT NULL DEFAULT 0,
+                    invoices INTEGER NOT NULL DEFAULT 0,
+                    finished_at DATETIME
+                )
+            ''')
+            
+            # Catalog change counter: every item insert, edit and delete
+            # takes the next version, and deleted items leave a tombstone, so
+            # offline-first tills can pull just what changed
+            cursor.execute('CREATE TABLE IF NOT EXISTS catalog_version (version INTEGER NOT NULL)')
+            cursor.execute('INSERT INTO catalog_version SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM catalog_version)')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS item_tombstones (
+                    id INTEGER PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )
+            ''')
+            
+            # An offline-first till's watermarks: the catalog version it has
+            # pulled and the last of its invoices the store has
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+            
+            # Full-text index over item names for invoice search, kept in step
+            # with items by triggers
+            cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5 (name, content='items', content_rowid='id')")
+            
+            self._migrate(cursor)
+            
+            # Triggers on items come after the migrations, which may rebuild it
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+                    INSERT INTO items_fts (rowid, name) VALUES (new.id, new.name);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+                    INSERT INTO items_fts (items_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name ON items BEGIN
+                    INSERT INTO items_fts (items_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO items_fts (rowid, name) VALUES (new.id, new.name);
+                END
+            ''')
+            
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS items_version_insert AFTER INSERT ON items BEGIN
+                    UPDATE catalog_version SET version = version + 1;
+                    UPDATE items SET version = (SELECT version FROM catalog_version) WHERE id = new.id;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS items_version_update AFTER UPDATE OF name, price, image_hash ON items
+                WHEN old.name IS NOT new.name OR old.price IS NOT new.price OR old.image_hash IS NOT new.image_hash
+                BEGIN
+                    UPDATE catalog_version SET version = version + 1;
+                    UPDATE items SET version = (SELECT version FROM catalog_version) WHERE id = new.id;
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS items_version_delete AFTER DELETE ON items BEGIN
+                    UPDATE catalog_version SET version = version + 1;
+                    INSERT OR REPLACE INTO item_tombstones (id, version)
+                    VALUES (old.id, (SELECT version FROM catalog_version));
+                END
+            ''')
+            
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_items_name ON items (name)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_items_version ON items (version)')
+            cursor.execute('DROP INDEX IF EXISTS idx_sales_item_id')
+            # Also rebuilds any an interrupted bulk import left dropped
+            for sql in self.HISTORY_INDEXES.values():
+                cursor.execute(sql)
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_uid ON invoices (uid)')
+            
+            self._prune_invoice_counters(cursor)
+            conn.commit()
+    
+    def _migrate(self, cursor):
+        """Bring a database written by an older version up to date.
+        PRAGMA user_version records how many migrations have been applied."""
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        for target, migration in enumerate(self.MIGRATIONS, start=1):
+            if version < target:
+                migration(self, cursor)
+        cursor.execute(f'PRAGMA user_version = {len(self.MIGRATIONS)}')
+    
+    def _migrate_invoices(self, cursor):
+        """Create invoice rows for sales recorded before invoices existed"""
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(sales)')]
+        if 'invoice_id' not in columns:
+            cursor.execute('ALTER TABLE sales ADD COLUMN invoice_id INTEGER REFERENCES invoices (id)')
+        
+        # Old versions treated all sales recorded in the same second as one invoice
+        groups = cursor.execute('''
+            SELECT 
+                strftime('%Y-%m-%d %H:%M:%S', sale_date) as second,
+                MIN(sale_date),
+                COUNT(DISTINCT item_id),
+                SUM(quantity),
+                SUM(total_price)
+            FROM sales
+            WHERE invoice_id IS NULL AND sale_date IS NOT NULL
+            GROUP BY second
+            ORDER BY second
+        ''').fetchall()
+        
+        # Map each second to its new invoice, then point every sale at its
+        # invoice in one pass rather than one scan of sales per invoice
+        cursor.execute('DROP TABLE IF EXISTS temp.invoice_backfill')
+        cursor.execute('''
+            CREATE TEMP TABLE invoice_backfill (
+                second TEXT PRIMARY KEY,
+                invoice_id INTEGER NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        numbers = {}
+        for second, created_at, item_count, quantity, total in groups:
+            day = second[:10]
+            numbers[day] = numbers.get(day, 0) + 1
+            cursor.execute('''
+                INSERT INTO invoices (number, created_at, item_count, total_quantity, total)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (numbers[day], created_at, item_count, quantity, total))
+            cursor.execute('INSERT INTO temp.invoice_backfill (second, invoice_id) VALUES (?, ?)',
+                           (second, cursor.lastrowid))
+        cursor.execute('''
+            UPDATE sales SET invoice_id = b.invoice_id
+            FROM temp.invoice_backfill b
+            WHERE sales.invoice_id IS NULL AND sales.sale_date IS NOT NULL
+              AND b.second = strftime('%Y-%m-%d %H:%M:%S', sales.sale_date)
+        ''')
+        cursor.execute('DROP TABLE temp.invoice_backfill')
+        
+        # Later invoices must not reuse the backfilled numbers
+        cursor.executemany('''
+            INSERT INTO daily_invoice_count (date, count) VALUES (?, ?)
+            ON CONFLICT (date) DO UPDATE SET count = MAX(count, excluded.count)
+        ''', numbers.items())
+    
+    def _migrate_images(self, cursor):
+        """Move base64 images out of the items table into the image store"""
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(items)')]
+        if 'image_hash' not in columns:
+            cursor.execute('ALTER TABLE items ADD COLUMN image_hash TEXT')
+        if 'image_data' not in columns:
+            return
+        
+        # Thumbnails need Qt and are rendered the first time each image is shown
+        item_ids = cursor.execute('SELECT id FROM items WHERE image_data IS NOT NULL').fetchall()
+        for (item_id,) in item_ids:
+            encoded = cursor.execute('SELECT image_data FROM items WHERE id = ?', (item_id,)).fetchone()[0]
+            try:
+                image_hash = self._insert_image(cursor, base64.b64decode(encoded))
+            except ValueError:
+                image_hash = None
+            cursor.execute('UPDATE items SET image_hash = ?, image_data = NULL WHERE id = ?',
+                          (image_hash, item_id))
+    
+    def _migrate_rollup(self, cursor):
+        """Fill sales_rollup from the sales recorded so far"""
+        cursor.execute('DELETE FROM sales_rollup')
+        cursor.execute('INSERT INTO sales_rollup (day, item_id, quantity, revenue_cents) ' + ROLLUP_FROM_SALES_SQL)
+    
+    def _migrate_invoice_uid(self, cursor):
+        """Give invoices a uid so a journaled sale is never written twice"""
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(invoices)')]
+        if 'uid' not in columns:
+            cursor.execute('ALTER TABLE invoices ADD COLUMN uid TEXT')
+    
+    def _migrate_items_fts(self, cursor):
+        """Index the names of items added before item search existed"""
+        cursor.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+    
+    def _migrate_catalog_versions(self, cursor):
+        """Give items the version offline-first tills pull changes by"""
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(items)')]
+        if 'version' not in columns:
+            cursor.execute('ALTER TABLE items ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+    
+    def _migrate_item_autoincrement(self, cursor):
+        """Rebuild items with AUTOINCREMENT so deleted item ids are not reused.
+        Dropping the old table drops its indexes and triggers, which _init_db
+        creates again after the migrations."""
+        sql = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'items'").fetchone()[0]
+        if 'AUTOINCREMENT' in sql.upper():
+            return
+        cursor.execute('''
+            CREATE TABLE items_autoincrement (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                price REAL NOT NULL,
+                image_hash TEXT,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('''
+            INSERT INTO items_autoincrement (id, name, price, image_hash, version)
+            SELECT id, name, price, image_hash, version FROM items
+        ''')
+        # New ids start past every id known to have been used, including
+        # deleted items that still have a tombstone or sales. The sequence
+        # row follows the table when it is renamed.
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'items_autoincrement'")
+        cursor.execute('''
+            INSERT INTO sqlite_sequence (name, seq)
+            SELECT 'items_autoincrement', MAX(IFNULL((SELECT MAX(id) FROM items), 0),
+                                IFNULL((SELECT MAX(id) FROM item_tombstones), 0),
+                                IFNULL((SELECT MAX(item_id) FROM sales), 0))
+        ''')
+        cursor.execute('DROP TABLE items')
+        cursor.execute('ALTER TABLE items_autoincrement RENAME TO items')
+    
+    MIGRATIONS = (_migrate_invoices, _migrate_images, _migrate_rollup, _migrate_invoice_uid,
+                  _migrate_items_fts, _migrate_catalog_versions, _migrate_item_autoincrement)
+    
+    def _insert_image(self, cursor, data, thumbnails=None):
+        image_hash = hashlib.sha256(data).hexdigest()
+        cursor.execute('INSERT OR IGNORE INTO images (hash, data) VALUES (?, ?)', (image_hash, data))
+        if thumbnails:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO image_thumbnails (hash, width, height, data)
+                VALUES (?, ?, ?, ?)
+            ''', [(image_hash, width, height, thumb) for (width, height), thumb in thumbnails.items()])
+        return image_hash
+    
+    def drop_history_indexes(self):
+        """Drop the history indexes a bulk import does not need"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for name in self.HISTORY_INDEXES:
+                if name not in self.IMPORT_INDEXES:
+                    cursor.execute(f'DROP INDEX IF EXISTS {name}')
+            conn.commit()
+    
+    def create_history_indexes(self):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for sql in self.HISTORY_INDEXES.values():
+                cursor.execute(sql)
+            conn.commit()
+    
+    def _prune_invoice_counters(self, cursor, keep_days=30):
+        """Forget invoice counters for days long past; run at startup rather
+        than on every checkout"""
+        cursor.execute("DELETE FROM daily_invoice_count WHERE date < date('now', ?)",
+                      (f'-{keep_days} days',))
+    
+    def prune_images(self):
+        """Drop stored images that no item refers to any more; returns how
+        many were dropped. Run as maintenance, not at every start, so it
+        cannot catch an image another till has stored but not yet used."""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            pruned = cursor.execute('''
+                DELETE FROM images
+                WHERE hash NOT IN (SELECT image_hash FROM items WHERE image_hash IS NOT NULL)
+            ''').rowcount
+            cursor.execute('DELETE FROM image_thumbnails WHERE hash NOT IN (SELECT hash FROM images)')
+            conn.commit()
+        return pruned
+    
+    def store_image(self, data, thumbnails=None):
+        """Store image bytes and their thumbnails ({(width, height): bytes});
+        returns the content hash the items table refers to"""
+        with self.get_connection() as conn:
+            image_hash = self._insert_image(conn.cursor(), data, thumbnails)
+            conn.commit()
+        return image_hash
+    
+    def store_thumbnail(self, image_hash, size, data):
+        with self.get_connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO image_thumbnails (hash, width, height, data)
+                VALUES (?, ?, ?, ?)
+            ''', (image_hash, size[0], size[1], data))
+            conn.commit()
+    
+    def get_image(self, image_hash):
+        with self.get_connection() as conn:
+            row = conn.execute('SELECT data FROM images WHERE hash = ?', (image_hash,)).fetchone()
+        return row[0] if row else None
+    
+    def get_thumbnail(self, image_hash, size):
+        with self.get_connection() as conn:
+            row = conn.execute(THUMBNAIL_SQL, (image_hash, size[0], size[1])).fetchone()
+        return row[0] if row else None
+    
+    def record_sale(self, lines, sale_time=None):
+        """Write a checkout as one transaction: invoice number, invoice row and
+        every line, all stamped with the same time.
+
+        lines are cart lines (item_id, name, quantity, total in cents).
+        Returns (invoice_id, invoice_number, sale_time). In write-behind mode
+        the sale is only appended to the journal and invoice_id is None.
+        """
+        lines = list(lines)
+        sale_time = sale_time or datetime.now()
+        day = sale_time.strftime('%Y-%m-%d')
+        started = time.perf_counter()
+        invoice_number = self.invoice_numbers.take_reserved(self, day)
+        uid = uuid.uuid4().hex
+        rows = [(line.item_id, line.quantity, line.total) for line in lines]
+        if self.sales_journal is not None:
+            with self.get_connection() as conn:
+                self._check_items(conn.cursor(), lines)
+            self.sales_journal.append({'uid': uid, 'number': invoice_number,
+                                       'created_at': str(sale_time), 'lines': rows})
+            if not self.invoice_numbers.has_spare(day):
+                # Have the journal thread claim the next block now
+                self.sales_journal.wake()
+            invoice_id = None
+        else:
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                self._check_items(cursor, lines)
+                if invoice_number is None:
+                    invoice_number = self.invoice_numbers.reserve(cursor, day)
+                invoice_id = self._write_invoice(cursor, uid, invoice_number, sale_time, rows)
+                conn.commit()
+        
+        self.checkout_latency.record((time.perf_counter() - started) * 1000)
+        return invoice_id, invoice_number, sale_time
+    
+    def _check_items(self, cursor, lines):
+        item_ids = [line.item_id for line in lines]
+        placeholders = ', '.join('?' * len(item_ids))
+        known = {row[0] for row in cursor.execute(
+            f'SELECT id FROM items WHERE id IN ({placeholders})', item_ids)}
+        for line in lines:
+            if line.item_id not in known:
+                raise ValueError(f"Item {line.name} not found")
+    
+    def _write_invoice(self, cursor, uid, number, created_at, rows):
+        """Insert an invoice with its sales and rollup rows; rows are
+        (item_id, quantity, total in cents). Returns the invoice id, or None
+        if an invoice with this uid was already written."""
+        day = str(created_at)[:10]
+        written = cursor.execute(INVOICE_INSERT_SQL, (uid, number, created_at, len(rows),
+                                                      sum(row[1] for row in rows),
+                                                      sum(row[2] for row in rows) / 100)).fetchone()
+        if written is None:
+            return None
+        invoice_id = written[0]
+        
+        cursor.executemany('''
+            INSERT INTO sales (item_id, quantity, total_price, sale_date, invoice_id)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(item_id, quantity, total / 100, created_at, invoice_id)
+              for item_id, quantity, total in rows])
+        cursor.executemany(ROLLUP_UPSERT_SQL, [(day, item_id, quantity, total)
+                                               for item_id, quantity, total in rows])
+        return invoice_id
+    
+    def _apply_journaled_sales(self, entries):
+        """Write a batch of journaled sales in one transaction"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            for entry in entries:
+                self._write_invoice(cursor, entry['uid'], entry['number'],
+                                    entry['created_at'], entry['lines'])
+            conn.commit()
+    
+    def list_items(self):
+        """(id, name, price, image_hash) for the whole catalog"""
+        with self.get_connection() as conn:
+            return conn.execute(ITEM_LIST_SQL).fetchall()
+    
+    def _catch_up(self):
+        """Apply journaled sales before a query that should include them"""
+        if self.sales_journal is not None and self.sales_journal.pending():
+            self.sales_journal.flush()
+    
+    def invoice_page(self, since, after, limit, order_by='created_at', descending=True, search=None):
+        """Up to limit invoices created after since, ordered by order_by and
+        continuing past the (order_by value, id) key after; None starts from
+        the first invoice in that order.
+
+        With an InvoiceSearch the whole history is searched instead and
+        since is ignored. Archived years the range reaches are queried too and
+        their pages merged with the live one.
+        """
+        if after is None:
+            # SQLite sorts numbers before text, so -inf precedes every value
+            if not descending:
+                after = (float('-inf'), 0)
+            elif order_by == 'created_at':
+                after = (datetime.max, 0)
+            else:
+                after = (float('inf'), 0)
+        if search:
+            start = search.start
+            end = search.end + timedelta(days=1) if search.end is not None else None
+        else:
+            start, end = since, None
+        self._catch_up()
+        pages = []
+        with self.get_connection() as conn:
+            for schema in self._partitions(conn, start, end):
+                if search:
+                    sql, params = self._invoice_search_sql(conn, search, order_by, descending, schema)
+                else:
+                    sql, params = _in_schema(INVOICE_HISTORY_SQL[order_by, descending], schema), [since]
+                pages.append(conn.execute(sql, (*params, after[0], after[1], limit)).fetchall())
+        if len(pages) == 1:
+            return pages[0]
+        # Rows are (id, number, created_at, total_quantity, total)
+        column = INVOICE_SORT_COLUMNS.index(order_by) + 1
+        merged = heapq.merge(*pages, key=lambda row: (row[column], row[0]), reverse=descending)
+        return list(itertools.islice(merged, limit))
+    
+    # Fewer sales lines than this for the searched items and the matching
+    # invoices are looked up directly; more, and invoices are walked in page
+    # order and each one checked
+    RARE_ITEM_SALES = 5000
+    
+    # Invoice searches whose plans are checked, with the number of sales
+    # lines to assume for the searched items, so both item filters are
+    PLANNED_SEARCHES = {
+        'search_number': (InvoiceSearch(number=12), None),
+        'search_dates_totals': (InvoiceSearch(start=date(2000, 1, 1), end=date(2000, 1, 31),
+                                              min_total=1, max_total=100), None),
+        'search_item_rare': (InvoiceSearch(item='bread'), 0),
+        'search_item_common': (InvoiceSearch(item='bread'), RARE_ITEM_SALES),
+        'search_item_dates': (InvoiceSearch(start=date(2000, 1, 1), end=date(2000, 1, 31),
+                                            item='bread'), 0),
+    }
+    
+    def _invoice_search_sql(self, conn, search, order_by, descending, schema='main', item_sales=None):
+        """Keyset page query for an InvoiceSearch and its parameters, less
+        the key and limit. Every criterion can be answered from an index.
+        item_sales, how many sales lines the searched items have, is
+        estimated when None."""
+        conditions = []
+        params = []
+        if search.number is not None:
+            conditions.append('number = ?')
+            params.append(search.number)
+        if search.start is not None:
+            conditions.append('created_at >= ?')
+            params.append(search.start.isoformat())
+        if search.end is not None:
+            conditions.append('created_at < ?')
+            params.append((search.end + timedelta(days=1)).isoformat())
+        if search.min_total is not None:
+            conditions.append('total >= ?')
+            params.append(search.min_total)
+        if search.max_total is not None:
+            conditions.append('total <= ?')
+            params.append(search.max_total)
+        if search.item:
+            match = search.item_match()
+            if item_sales is None:
+                item_sales = conn.execute(_in_schema(ITEM_SALES_ESTIMATE_SQL, schema),
+                                          (match, self.RARE_ITEM_SALES)).fetchone()[0]
+            if item_sales < self.RARE_ITEM_SALES:
+                conditions.append('''id IN (
+                    SELECT invoice_id FROM sales
+                    WHERE item_id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?))''')
+            else:
+                conditions.append('''EXISTS (
+                    SELECT 1 FROM sales
+                    WHERE invoice_id = invoices.id
+                      AND item_id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?))''')
+            params.append(match)
+        direction = 'DESC' if descending else 'ASC'
+        conditions.append(f"({order_by}, id) {'<' if descending else '>'} (?, ?)")
+        sql = f'''
+            SELECT id, number, created_at, total_quantity, total
+            FROM invoices
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order_by} {direction}, id {direction}
+            LIMIT ?
+        '''
+        return _in_schema(sql, schema), params
+    
+    def invoice_details(self, invoice_id):
+        """(number, created_at, total) and the (name, quantity, total_price)
+        lines of one invoice"""
+        with self.get_connection() as conn:
+            schemas = ['main']
+            # Archives whose id range holds the invoice, should it not be live
+            schemas.extend(self._attach(conn, year, path) for year, path in conn.execute('''
+                SELECT year, path FROM archives WHERE ? BETWEEN first_invoice_id AND last_invoice_id
+            ''', (invoice_id,)).fetchall())
+            for schema in schemas:
+                invoice = conn.execute(_in_schema(INVOICE_SQL, schema), (invoice_id,)).fetchone()
+                if invoice is not None:
+                    return invoice, conn.execute(_in_schema(INVOICE_DETAILS_SQL, schema),
+                                                 (invoice_id,)).fetchall()
+        return None, []
+    
+    def sales_summary(self, start, end):
+        """(name, quantity, cents) per item for days in [start, end), from the
+        live rollup and those of any archived years in the range"""
+        self._catch_up()
+        params = (start.isoformat(), end.isoformat())
+        with self.get_connection() as conn:
+            summaries = [conn.execute(_in_schema(SALES_SUMMARY_SQL, schema), params).fetchall()
+                         for schema in self._partitions(conn, start, end)]
+        if len(summaries) == 1:
+            return summaries[0]
+        totals = {}
+        for summary in summaries:
+            for name, quantity, cents in summary:
+                total = totals.setdefault(name, [0, 0])
+                total[0] += quantity
+                total[1] += cents
+        return [(name, quantity, cents) for name, (quantity, cents) in sorted(totals.items())]
+    
+    def rebuild_rollup(self):
+        """Recompute sales_rollup from raw sales.
+
+        Returns the rows that disagreed before the rebuild as
+        (day, item_id, expected (quantity, cents), stored (quantity, cents));
+        a missing row is reported as None.
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DROP TABLE IF EXISTS temp.expected_rollup')
+            # Keyed like sales_rollup, so checking it for each stored row is
+            # a lookup rather than a scan
+            cursor.execute('''
+                CREATE TEMP TABLE expected_rollup (
+                    day TEXT NOT NULL,
+                    item_id INTEGER NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    revenue_cents INTEGER NOT NULL,
+                    PRIMARY KEY (day, item_id)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('INSERT INTO temp.expected_rollup ' + ROLLUP_FROM_SALES_SQL)
+            rows = cursor.execute('''
+                SELECT e.day, e.item_id, e.quantity, e.revenue_cents, r.quantity, r.revenue_cents
+                FROM temp.expected_rollup e
+                LEFT JOIN sales_rollup r ON r.day = e.day AND r.item_id = e.item_id
+                WHERE r.quantity IS NOT e.quantity OR r.revenue_cents IS NOT e.revenue_cents
+                UNION ALL
+                SELECT r.day, r.item_id, NULL, NULL, r.quantity, r.revenue_cents
+                FROM sales_rollup r
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM temp.expected_rollup e
+                    WHERE e.day = r.day AND e.item_id = r.item_id
+                )
+            ''').fetchall()
+            
+            cursor.execute('DELETE FROM sales_rollup')
+            cursor.execute('''
+                INSERT INTO sales_rollup (day, item_id, quantity, revenue_cents)
+                SELECT day, item_id, quantity, revenue_cents FROM temp.expected_rollup
+            ''')
+            cursor.execute('DROP TABLE temp.expected_rollup')
+            conn.commit()
+        
+        return [(day, item_id,
+                 None if expected_qty is None else (expected_qty, expected_cents),
+                 None if stored_qty is None else (stored_qty, stored_cents))
+                for day, item_id, expected_qty, expected_cents, stored_qty, stored_cents in rows]
+    
+    # SQLite allows ten attached databases by default; archives past this
+    # many are detached least recently used first
+    ATTACHED_ARCHIVES = 8
+    
+    def _attach(self, conn, year, path):
+        """Schema name of an archive on conn, attaching it if need be"""
+        schema = f'archive_{year}'
+        if schema in conn.archives:
+            conn.archives.move_to_end(schema)
+            return schema
+        if len(conn.archives) >= self.ATTACHED_ARCHIVES:
+            stale, _ = conn.archives.popitem(last=False)
+            conn.execute(f'DETACH DATABASE {stale}')
+        folder = os.path.dirname(os.path.abspath(self.db_name))
+        conn.execute(f'ATTACH DATABASE ? AS {schema}', (os.path.join(folder, path),))
+        conn.archives[schema] = path
+        return schema
+    
+    def _partitions(self, conn, start=None, end=None):
+        """'main' and then the schema of each archived year overlapping
+        [start, end), attached one at a time as the caller gets to it"""
+        yield 'main'
+        first = str(start) if start is not None else ''
+        last = str(end) if end is not None else '9999'
+        for year, path in conn.execute('SELECT year, path FROM archives ORDER BY year DESC').fetchall():
+            if f'{year:04d}-01-01' < last and first < f'{year + 1:04d}-01-01':
+                yield self._attach(conn, year, path)
+    
+    def archive(self, before_year=None):
+        """Archive every year before before_year (by default this one) that
+        still has live invoices; returns {year: invoices moved}"""
+        before_year = before_year or datetime.now().year
+        self._catch_up()
+        with self.get_connection() as conn:
+            oldest = conn.execute('SELECT MIN(created_at) FROM invoices').fetchone()[0]
+        moved = {}
+        if oldest is None:
+            return moved
+        for year in range(int(oldest[:4]), before_year):
+            with self.get_connection() as conn:
+                live = conn.execute('''
+                    SELECT 1 FROM invoices WHERE created_at >= ? AND created_at < ? LIMIT 1
+                ''', (f'{year:04d}-01-01', f'{year + 1:04d}-01-01')).fetchone()
+            if live:
+                moved[year] = self.archive_year(year)
+        return moved
+    
+    def archive_year(self, year):
+        """Move a year's invoices, sales and rollup out to sales_YYYY.db next
+        to the live file, adding to it if the year was archived before.
+        Returns the number of invoices moved."""
+        path = f'sales_{year}.db'
+        span = (f'{year:04d}-01-01', f'{year + 1:04d}-01-01')
+        moving = 'SELECT id FROM main.invoices WHERE created_at >= ? AND created_at < ?'
+        with self.get_connection() as conn:
+            schema = self._attach(conn, year, path)
+            cursor = conn.cursor()
+            # With WAL a transaction over two files is not atomic as a whole,
+            # so copy in one and delete from the live file in another. Should
+            # the second never happen, archiving the year again redoes the
+            # copy in place and finishes the move.
+            cursor.execute('BEGIN IMMEDIATE')
+            self._create_archive_tables(cursor, schema)
+            cursor.execute(f'INSERT OR REPLACE INTO {schema}.invoices SELECT * FROM main.invoices '
+                           f'WHERE created_at >= ? AND created_at < ?', span)
+            cursor.execute(f'DELETE FROM {schema}.sales WHERE invoice_id IN ({moving})', span)
+            cursor.execute(f'''
+                INSERT INTO {schema}.sales (item_id, quantity, total_price, sale_date, invoice_id)
+                SELECT item_id, quantity, total_price, sale_date, invoice_id FROM main.sales
+                WHERE invoice_id IN ({moving})
+                ORDER BY id
+            ''', span)
+            cursor.execute(f'DELETE FROM {schema}.sales_rollup')
+            cursor.execute(f'INSERT INTO {schema}.sales_rollup (day, item_id, quantity, revenue_cents) '
+                           + _in_schema(ROLLUP_FROM_SALES_SQL, schema))
+            conn.commit()
+            
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(f'DELETE FROM main.sales WHERE invoice_id IN ({moving})', span)
+            moved = cursor.execute('DELETE FROM main.invoices WHERE created_at >= ? AND created_at < ?',
+                                   span).rowcount
+            cursor.execute('DELETE FROM main.sales_rollup WHERE day >= ? AND day < ?', span)
+            cursor.execute(f'''
+                INSERT OR REPLACE INTO archives (year, path, first_invoice_id, last_invoice_id,
+                                                 invoices, archived_at)
+                SELECT ?, ?, MIN(id), MAX(id), COUNT(*), ? FROM {schema}.invoices
+            ''', (year, path, datetime.now()))
+            conn.commit()
+        return moved
+    
+    def _create_archive_tables(self, cursor, schema):
+        """Give an attached archive the live file's archived tables and their
+        indexes, unless it has them already"""
+        for (sql,) in cursor.execute(f'''
+            SELECT sql FROM main.sqlite_master
+            WHERE tbl_name IN ({', '.join('?' * len(ARCHIVED_TABLES))}) AND sql IS NOT NULL
+            ORDER BY type DESC
+        ''', ARCHIVED_TABLES).fetchall():
+            cursor.execute(re.sub(r'^CREATE (TABLE|UNIQUE INDEX|INDEX) ',
+                                  rf'CREATE \1 IF NOT EXISTS {schema}.', sql))
+    
+    def vacuum(self):
+        """Rewrite the live file without the free pages archiving leaves"""
+        with self.get_connection() as conn:
+            conn.execute('VACUUM')
+    
+    def check_query_plans(self):
+        """Return the plan of every planned query, raising if any of them
+        falls back to a full table scan"""
+        plans = {}
+        scans = []
+        with self.get_connection() as conn:
+            # An empty archive made the way archive_year makes one stands in
+            # for the archived years
+            conn.execute("ATTACH DATABASE ':memory:' AS planned_archive")
+            try:
+                self._create_archive_tables(conn.cursor(), 'planned_archive')
+                for name, sql, params in self._planned_queries(conn):
+                    details = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+                    plans[name] = details
+                    scans.extend(f"{name}: {detail}" for detail in details if _is_table_scan(detail))
+            finally:
+                conn.execute('DETACH DATABASE planned_archive')
+        if scans:
+            raise RuntimeError("Full table scans in query plans:\n" + "\n".join(scans))
+        return plans
+    
+    def _planned_queries(self, conn):
+        """(name, sql, params) of every planned query and search, live and
+        against the planned_archive schema"""
+        for schema, prefix in (('main', ''), ('planned_archive', 'archive_')):
+            for name, (sql, params) in self.PLANNED_QUERIES.items():
+                archived = _in_schema(sql, schema)
+                if schema == 'main' or archived != sql:
+                    yield prefix + name, archived, params
+            for name, (search, item_sales) in self.PLANNED_SEARCHES.items():
+                sql, params = self._invoice_search_sql(conn, search, 'created_at', True, schema, item_sales)
+                yield prefix + name, sql, (*params, '9999-12-31', 0, 200)
+
+
+# Columns of a catalog file; image is a path relative to the image folder
+CATALOG_FIELDS = ('name', 'price', 'image')
+
+IMAGE_SIGNATURES = ((b'\x89PNG\r\n\x1a\n', '.png'), (b'\xff\xd8\xff', '.jpg'), (b'GIF8', '.gif'),
+                    (b'BM', '.bmp'))
+
+
+def image_extension(data):
+    """File extension for encoded image bytes, from their signature"""
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    return '.img'
+
+
+def read_catalog(path):
+    """(name, price, image) for every entry of a CSV or JSON catalog file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            records = json.load(f)
+        else:
+            records = list(csv.DictReader(f))
+    rows = []
+    for entry, record in enumerate(records, start=1):
+        name = (record.get('name') or '').strip()
+        if not name:
+            raise ValueError(f"Catalog entry {entry} has no name")
+        try:
+            price = float(record.get('price'))
+        except (TypeError, ValueError):
+            raise ValueError(f"Catalog entry {entry} ({name}) has no valid price") from None
+        rows.append((name, price, record.get('image') or None))
+    return rows
+
+
+def load_image(path, render=None):
+    """Image file bytes and, given a render function, their thumbnails.
+    Runs in the import process pool, so render must be module-level."""
+    with open(path, 'rb') as image_file:
+        data = image_file.read()
+    return data, render(data) if render else None
+
+
+class InventoryService:
+    """The item catalog"""
+    # Catalog imports with more images than this read and thumbnail them in
+    # a process pool
+    IMPORT_POOL_THRESHOLD = 4
+    
+    def __init__(self, db):
+        self.db = db
+    
+    def list_items(self):
+        """(id, name, price, image_hash) for the whole catalog"""
+        return self.db.list_items()
+    
+    def get_item(self, item_id):
+        with self.db.get_connection() as conn:
+            return conn.execute(ITEM_SQL, (item_id,)).fetchone()
+    
+    def add_item(self, name, price, image_data=None, thumbnails=None):
+        """Add an item, storing its image in the same transaction; returns
+        the new item id"""
+        if not name:
+            raise ValueError("Please enter an item name")
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            image_hash = None
+            if image_data is not None:
+                image_hash = self.db._insert_image(cursor, image_data, thumbnails)
+            cursor.execute('INSERT INTO items (name, price, image_hash) VALUES (?, ?, ?)',
+                          (name, price, image_hash))
+            conn.commit()
+        return cursor.lastrowid
+    
+    def update_item(self, item_id, name, price, image_hash, image_data=None, thumbnails=None):
+        """Update an item. Given image_data, that image replaces image_hash
+        and is stored in the same transaction. Returns the item's image hash."""
+        if not name:
+            raise ValueError("Please enter an item name")
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            if image_data is not None:
+                image_hash = self.db._insert_image(cursor, image_data, thumbnails)
+            cursor.execute('''
+                UPDATE items 
+                SET name = ?, price = ?, image_hash = ?
+                WHERE id = ?
+            ''', (name, price, image_hash, item_id))
+            if not cursor.rowcount:
+                # Leaving the block rolls back the image stored for it
+                raise ValueError("Item not found")
+            conn.commit()
+        return image_hash
+    
+    def delete_item(self, item_id):
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM items WHERE id = ?', (item_id,))
+            conn.commit()
+        if not cursor.rowcount:
+            raise ValueError("Item not found")
+    
+    def store_image(self, data, thumbnails=None):
+        return self.db.store_image(data, thumbnails)
+    
+    def import_catalog(self, path, image_dir=None, render=None, workers=None):
+        """Add the items of a CSV or JSON catalog, updating those whose name
+        already exists, all in one transaction.
+
+        Image paths are relative to image_dir, by default the catalog's
+        folder; an entry without one keeps the item's current image.
+        Returns (added, updated).
+        """
+        rows = read_catalog(path)
+        image_dir = image_dir or os.path.dirname(os.path.abspath(path))
+        image_paths = sorted({image for _, _, image in rows if image})
+        files = [os.path.join(image_dir, image) for image in image_paths]
+        if len(files) > self.IMPORT_POOL_THRESHOLD:
+            # spawn rather than fork: the till has worker threads running
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                images = list(pool.map(partial(load_image, render=render), files))
+        else:
+            images = [load_image(file, render) for file in files]
+        return self.upsert_catalog(rows, dict(zip(image_paths, images)))
+    
+    def upsert_catalog(self, rows, images):
+        """The database half of import_catalog: rows are (name, price, image)
+        and images maps each image to its (data, thumbnails)"""
+        # A name listed twice takes its last entry
+        entries = {name: (price, image) for name, price, image in rows}
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            hashes = {image: self.db._insert_image(cursor, data, thumbnails)
+                      for image, (data, thumbnails) in images.items()}
+            existing = {row[0] for row in cursor.execute('SELECT name FROM items')}
+            updates = [(price, hashes.get(image), name)
+                       for name, (price, image) in entries.items() if name in existing]
+            inserts = [(name, price, hashes.get(image))
+                       for name, (price, image) in entries.items() if name not in existing]
+            cursor.executemany('UPDATE items SET price = ?, image_hash = COALESCE(?, image_hash) WHERE name = ?',
+                               updates)
+            cursor.executemany('INSERT INTO items (name, price, image_hash) VALUES (?, ?, ?)', inserts)
+            conn.commit()
+        return len(inserts), len(updates)
+    
+    def export_catalog(self, path, image_dir=None):
+        """Write the catalog as CSV or JSON (by path's extension) in the form
+        import_catalog reads, saving images to image_dir, by default an
+        images folder next to it; returns the number of items"""
+        folder = os.path.dirname(os.path.abspath(path))
+        image_dir = image_dir or os.path.join(folder, 'images')
+        records = []
+        written = {}
+        for _, name, price, image_hash in self.list_items():
+            image = None
+            if image_hash and image_hash not in written:
+                data = self.db.get_image(image_hash)
+                if data is not None:
+                    os.makedirs(image_dir, exist_ok=True)
+                    image_path = os.path.join(image_dir, image_hash[:16] + image_extension(data))
+                    with open(image_path, 'wb') as image_file:
+                        image_file.write(data)
+                    written[image_hash] = os.path.relpath(image_path, folder)
+            if image_hash:
+                image = written.get(image_hash)
+            records.append({'name': name, 'price': price, 'image': image})
+        
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            if path.lower().endswith('.json'):
+                json.dump(records, f, indent=2)
+                f.write('\n')
+            else:
+                writer = csv.DictWriter(f, CATALOG_FIELDS)
+                writer.writeheader()
+                writer.writerows(records)
+        return len(records)
+
+
+class SalesService:
+    """Checkout"""
+    def __init__(self, db):
+        self.db = db
+    
+    def checkout(self, lines, sale_time=None):
+        """Record a sale of CartLines; returns (invoice_id, invoice_number,
+        sale_time), with no invoice id yet when sales are journaled"""
+        lines = list(lines)
+        if not lines:
+            raise ValueError("No items in current sale")
+        return self.db.record_sale(lines, sale_time)
+
+
+class InvoicingService:
+    """Invoice history and details"""
+    def __init__(self, db):
+        self.db = db
+    
+    def page(self, since, after=None, limit=200, order_by='created_at', descending=True, search=None):
+        """See DatabaseManager.invoice_page"""
+        return self.db.invoice_page(since, after, limit, order_by, descending, search)
+    
+    def details(self, invoice_id):
+        return self.db.invoice_details(invoice_id)
+
+
+class ReportingService:
+    """Sales reports, read from the daily rollup"""
+    def __init__(self, db):
+        self.db = db
+    
+    def daily(self, day):
+        """(name, quantity, cents) per item sold on day"""
+        return self.db.sales_summary(day, day + timedelta(days=1))
+    
+    def monthly(self, day):
+        """(name, quantity, cents) per item sold in the month containing day"""
+        first_day = day.replace(day=1)
+        next_month = (first_day + timedelta(days=32)).replace(day=1)
+        return self.db.sales_summary(first_day, next_month)
+    
+    def rebuild_rollup(self):
+        return self.db.rebuild_rollup()
+
+
+class SyncService:
+    """The store side of offline-first tills: sales pushed in compressed
+    batches and catalog changes pulled by version"""
+    # Largest batch accepted once decompressed: a till's batch of 500
+    # invoices is well under a megabyte
+    MAX_BATCH_BYTES = 16 * 1024 * 1024
+    
+    def __init__(self, db):
+        self.db = db
+    
+    def push_sales(self, batch):
+        """Write a zlib-compressed JSON list of sales in the sales journal's
+        format. A sale the store already has (same uid) is skipped, so a
+        batch whose reply was lost can simply be sent again."""
+        inflate = zlib.decompressobj()
+        # One byte past the limit tells a batch that is too big from one
+        # that just fits
+        data = inflate.decompress(batch, self.MAX_BATCH_BYTES + 1)
+        if len(data) > self.MAX_BATCH_BYTES:
+            raise ValueError(f"Sales batch is larger than {self.MAX_BATCH_BYTES} bytes")
+        if not inflate.eof:
+            raise ValueError("Sales batch is incomplete")
+        entries = json.loads(data)
+        item_ids = sorted({line[0] for entry in entries for line in entry['lines']})
+        with self.db.get_connection() as conn:
+            # A deleted item's tombstone keeps its id valid: a till may have
+            # sold it before pulling the deletion
+            known = {row[0] for row in conn.execute('''
+                SELECT id FROM items WHERE id IN (SELECT value FROM json_each(?1))
+                UNION SELECT id FROM item_tombstones WHERE id IN (SELECT value FROM json_each(?1))
+            ''', (json.dumps(item_ids),))}
+        unknown = [item_id for item_id in item_ids if item_id not in known]
+        if unknown:
+            raise ValueError(f"Sales batch refers to unknown items {', '.join(map(str, unknown))}")
+        self.db._apply_journaled_sales(entries)
+        return len(entries)
+    
+    def catalog_changes(self, since=None):
+        """(version, items, deleted ids) changed after version since, or the
+        whole catalog and no deletions when since is None. Items are
+        (id, name, price, image_hash) rows."""
+        with self.db.get_connection() as conn:
+            # Read first: a change made meanwhile is sent now and again next time
+            version = conn.execute('SELECT version FROM catalog_version').fetchone()[0]
+            if since is None:
+                return version, conn.execute(ITEM_LIST_SQL).fetchall(), []
+            items = conn.execute(ITEM_LIST_SQL + ' WHERE version > ?', (since,)).fetchall()
+            deleted = [row[0] for row in conn.execute('SELECT id FROM item_tombstones WHERE version > ?',
+                                                      (since,))]
+        return version, items, deleted
+
+
+def read_sales_export(path):
+    """Records of a CSV or JSON Lines (.jsonl) sales export, one at a time.
+
+    Each record is one invoice line with invoice, date, item, quantity and
+    price (unit price) or total (line total). The lines of an invoice must
+    be next to each other; without an invoice value a line is an invoice of
+    its own.
+    """
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def parse_sales_records(records, start=0):
+    """(record number, invoice ref, created_at, item name, quantity, cents,
+    unit cents) for each record, numbering them from start + 1"""
+    for number, record in enumerate(records, start=start + 1):
+        name = (record.get('item') or '').strip()
+        if not name:
+            raise ValueError(f"Sales record {number} has no item")
+        try:
+            created_at = datetime.fromisoformat(str(record['date']))
+            quantity = int(record['quantity'])
+            price, total = record.get('price'), record.get('total')
+            if total not in (None, ''):
+                cents = to_cents(float(total))
+                unit_cents = to_cents(float(price)) if price not in (None, '') else cents // max(quantity, 1)
+            else:
+                unit_cents = to_cents(float(price))
+                cents = unit_cents * quantity
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Sales record {number} ({name}): {e}") from None
+        ref = record.get('invoice')
+        yield (number, f'line-{number}' if ref in (None, '') else str(ref), created_at, name,
+               quantity, cents, unit_cents)
+
+
+def group_invoice_lines(rows):
+    """(last record number, invoice ref, created_at, lines) per invoice"""
+    for ref, lines in itertools.groupby(rows, key=lambda row: row[1]):
+        lines = list(lines)
+        yield lines[-1][0], ref, lines[0][2], lines
+
+
+class SalesImporter:
+    """Streams a sales export from another till system into the history.
+
+    Records flow through generators, so memory stays flat however long the
+    export is. Invoices are written about batch_lines lines at a time, each
+    batch one transaction that also moves the import's checkpoint forward,
+    so an interrupted import resumes after its last committed batch. Invoice
+    uids are "<source>:<invoice ref>" and an invoice is never written twice.
+    """
+    def __init__(self, db, batch_lines=100000, create_items=True):
+        self.db = db
+        self.batch_lines = batch_lines
+        self.create_items = create_items
+        self.item_ids = {}
+        self._last_numbers = {}
+    
+    def run(self, path, source=None, defer_indexes=True, progress=None):
+        """Import path, or the rest of it after an interrupted run; returns
+        (records, invoices) imported for source so far. progress(records,
+        invoices) is called after each batch."""
+        source = source or os.path.basename(path)
+        with self.db.get_connection() as conn:
+            checkpoint = conn.execute(
+                'SELECT records, invoices, finished_at FROM import_checkpoints WHERE source = ?',
+                (source,)).fetchone()
+            self.item_ids = {name: item_id for item_id, name in conn.execute('SELECT id, name FROM items')}
+        records, invoices = checkpoint[:2] if checkpoint else (0, 0)
+        if checkpoint and checkpoint[2]:
+            return records, invoices
+        
+        pending = group_invoice_lines(parse_sales_records(
+            itertools.islice(read_sales_export(path), records, None), records))
+        if defer_indexes:
+            self.db.drop_history_indexes()
+        try:
+            batch = []
+            lines = 0
+            for invoice in pending:
+                batch.append(invoice)
+                lines += len(invoice[3])
+                if lines >= self.batch_lines:
+                    records, invoices = self._write_batch(source, batch, records, invoices)
+                    batch = []
+                    lines = 0
+                    if progress:
+                        progress(records, invoices)
+            records, invoices = self._write_batch(source, batch, records, invoices, finished=True)
+            if progress:
+                progress(records, invoices)
+        finally:
+            if defer_indexes:
+                self.db.create_history_indexes()
+        return records, invoices
+    
+    def _item_id(self, cursor, name, unit_cents):
+        item_id = self.item_ids.get(name)
+        if item_id is None:
+            if not self.create_items:
+                raise ValueError(f"Unknown item {name}")
+            cursor.execute('INSERT INTO items (name, price) VALUES (?, ?)', (name, unit_cents / 100))
+            item_id = self.item_ids[name] = cursor.lastrowid
+        return item_id
+    
+    def _next_number(self, cursor, day):
+        """Number invoices on after the last one that day already has"""
+        last = self._last_numbers.get(day)
+        if last is None:
+            start = datetime.fromisoformat(day)
+            row = cursor.execute('''
+                SELECT MAX(number) FROM invoices WHERE created_at >= ? AND created_at < ?
+            ''', (start, start + timedelta(days=1))).fetchone()
+            counter = cursor.execute('SELECT count FROM daily_invoice_count WHERE date = ?',
+                                    (day,)).fetchone()
+            last = max(row[0] or 0, counter[0] if counter else 0)
+        self._last_numbers[day] = last + 1
+        return last + 1
+    
+    def _write_batch(self, source, batch, records, invoices, finished=False):
+        """Write a batch of whole invoices and the checkpoint after them in
+        one transaction; returns the new (records, invoices)"""
+        with self.db.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            sales = []
+            rollup = {}
+            days = set()
+            for _, ref, created_at, lines in batch:
+                day = created_at.date().isoformat()
+                days.add(day)
+                rows = [(self._item_id(cursor, line[3], line[6]), line[4], line[5]) for line in lines]
+                written = cursor.execute(INVOICE_INSERT_SQL, (
+                    f'{source}:{ref}', self._next_number(cursor, day), created_at, len(rows),
+                    sum(row[1] for row in rows), sum(row[2] for row in rows) / 100)).fetchone()
+                if written is None:
+                    continue
+                invoices += 1
+                sales.extend((item_id, quantity, cents / 100, created_at, written[0])
+                             for item_id, quantity, cents in rows)
+                for item_id, quantity, cents in rows:
+                    totals = rollup.setdefault((day, item_id), [0, 0])
+                    totals[0] += quantity
+                    totals[1] += cents
+            
+            cursor.executemany('''
+                INSERT INTO sales (item_id, quantity, total_price, sale_date, invoice_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', sales)
+            cursor.executemany(ROLLUP_UPSERT_SQL, [(day, item_id, quantity, cents)
+                                                   for (day, item_id), (quantity, cents) in rollup.items()])
+            # Tills numbering a day this import touched carry on after it
+            cursor.executemany('''
+                INSERT INTO daily_invoice_count (date, count) VALUES (?, ?)
+                ON CONFLICT (date) DO UPDATE SET count = MAX(count, excluded.count)
+            ''', [(day, self._last_numbers[day]) for day in days])
+            if batch:
+                records = batch[-1][0]
+            cursor.execute('''
+                INSERT OR REPLACE INTO import_checkpoints (source, records, invoices, finished_at)
+                VALUES (?, ?, ?, ?)
+            ''', (source, records, invoices, datetime.now() if finished else None))
+            conn.commit()
+        return records, invoices
+
+
+class BackupManager:
+    """Point-in-time snapshots of the live database, taken while the till
+    keeps selling.
+
+    A snapshot holds one read transaction on the live file for its whole
+    run and copies it with SQLite's online backup API a few pages at a time.
+    Under WAL that read never blocks checkout, and because the pages it
+    reads cannot change under it the backup never has to restart. Each
+    snapshot is a folder holding the database and every archive file, and
+    only counts once PRAGMA integrity_check passes on all of them. Archives
+    unchanged since the previous snapshot are hard links to its copies. The
+    newest keep snapshots are kept.
+    """
+    PAGES_PER_STEP = 256
+    MANIFEST = 'snapshot.json'
+    
+    def __init__(self, db, folder=None, keep=14, step_pause=0.001):
+        self.db = db
+        self.folder = folder or db.db_name + '.backups'
+        self.keep = keep
+        self.step_pause = step_pause
+        self.errors = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def snapshots(self):
+        """Names of the complete snapshots, oldest first"""
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(name for name in os.listdir(self.folder)
+                      if os.path.exists(os.path.join(self.folder, name, self.MANIFEST)))
+    
+    def manifest(self, name):
+        with open(os.path.join(self.folder, name, self.MANIFEST)) as f:
+            return json.load(f)
+    
+    def _copy(self, source, target):
+        """Copy source into a new file at target, pausing between steps so
+        the till gets the disk too"""
+        copy = sqlite3.connect(target)
+        try:
+            source.backup(copy, pages=self.PAGES_PER_STEP,
+                          progress=lambda status, remaining, total: time.sleep(self.step_pause))
+            # A snapshot is one self-contained file, not a WAL pair
+            copy.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            copy.close()
+    
+    def snapshot(self):
+        """Take a snapshot now and prune old ones; returns its name"""
+        name = self._snapshot()
+        self.prune()
+        return name
+    
+    def _snapshot(self):
+        with self._lock:
+            stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            latest = max(self.snapshots(), default='')
+            name, count = stamp, 1
+            # Zero-padded, and past every snapshot kept so far (a pruned
+            # name must not come back ahead of newer ones), so the names
+            # sort in the order taken
+            while name <= latest or os.path.exists(os.path.join(self.folder, name)):
+                count += 1
+                name = f'{stamp}-{count:03d}'
+            partial = os.path.join(self.folder, name + '.partial')
+            os.makedirs(partial)
+            try:
+                database = os.path.basename(self.db.db_name)
+                previous = self.snapshots()[-1:]
+                reusable = self.manifest(previous[0])['archives'] if previous else {}
+                manifest = {'created_at': str(datetime.now()), 'database': database, 'archives': {}}
+                source, archives, pinned = self._pin(reusable)
+                try:
+                    self._copy(source, os.path.join(partial, database))
+                    for year, path, archived_at in archives:
+                        target = os.path.join(partial, path)
+                        if year in pinned:
+                            self._copy(pinned[year], target)
+                        else:
+                            os.link(os.path.join(self.folder, previous[0], path), target)
+                        manifest['archives'][str(year)] = {'path': path, 'archived_at': str(archived_at)}
+                finally:
+                    for conn in [source, *pinned.values()]:
+                        conn.close()
+                
+                self._verify_folder(partial)
+                with open(os.path.join(partial, self.MANIFEST), 'w') as f:
+                    json.dump(manifest, f, indent=2)
+                os.rename(partial, os.path.join(self.folder, name))
+            except BaseException:
+                shutil.rmtree(partial, ignore_errors=True)
+                raise
+            return name
+    
+    # How often to look again when an archive is caught part way through
+    # moving a year, and how long to wait in between
+    PIN_ATTEMPTS = 20
+    PIN_RETRY_SECONDS = 0.5
+    
+    def _pin(self, reusable):
+        """Open read transactions that pin the live file and then each archive
+        it lists that cannot be reused from the previous snapshot. Returns
+        the live connection, the (year, path, archived_at) rows of the
+        archives and {year: connection} for the pinned archives."""
+        live_folder = os.path.dirname(os.path.abspath(self.db.db_name))
+        for _ in range(self.PIN_ATTEMPTS):
+            source = sqlite3.connect(self.db.db_name, isolation_level=None)
+            pinned = {}
+            try:
+                source.execute('BEGIN')
+                archives = source.execute('SELECT year, path, archived_at FROM archives').fetchall()
+                moving = False
+                for year, path, archived_at in archives:
+                    if reusable.get(str(year)) == {'path': path, 'archived_at': str(archived_at)}:
+                        # The earlier copy is older still, so it cannot hold
+                        # rows this version of the live file no longer has
+                        continue
+                    span = (f'{year:04d}-01-01', f'{year + 1:04d}-01-01')
+                    live = [invoice_id for (invoice_id,) in source.execute(
+                        'SELECT id FROM invoices WHERE created_at >= ? AND created_at < ?', span)]
+                    pinned[year] = archive = sqlite3.connect(os.path.join(live_folder, path),
+                                                             isolation_level=None)
+                    # Pinned after the live file: archive_year copies a year
+                    # out before deleting it, so a row can be in both files
+                    # but never in neither. Being in both means a move is
+                    # half done.
+                    archive.execute('BEGIN')
+                    if archive.execute('SELECT 1 FROM invoices WHERE id IN (SELECT value FROM json_each(?)) LIMIT 1',
+                                       (json.dumps(live),)).fetchone():
+                        moving = True
+                        break
+                if not moving:
+                    return source, archives, pinned
+            except BaseException:
+                for conn in [source, *pinned.values()]:
+                    conn.close()
+                raise
+            for conn in [source, *pinned.values()]:
+                conn.close()
+            time.sleep(self.PIN_RETRY_SECONDS)
+        raise RuntimeError("An archive is part way through moving a year; "
+                           "let it finish, or archive again, then retry the backup")
+    
+    def verify(self, name):
+        """Raise RuntimeError if a file of the snapshot fails PRAGMA integrity_check"""
+        self._verify_folder(os.path.join(self.folder, name))
+    
+    def _verify_folder(self, folder):
+        for file_name in sorted(os.listdir(folder)):
+            if not file_name.endswith('.db'):
+                continue
+            conn = sqlite3.connect(f'file:{os.path.join(folder, file_name)}?mode=ro', uri=True)
+            try:
+                result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+            finally:
+                conn.close()
+            if result != ['ok']:
+                raise RuntimeError(f"{file_name} in {folder} is damaged: {'; '.join(result[:5])}")
+    
+    def prune(self):
+        """Delete all but the newest keep snapshots"""
+        with self._lock:
+            for name in self.snapshots()[:-self.keep]:
+                shutil.rmtree(os.path.join(self.folder, name))
+    
+    def restore(self, name):
+        """Replace the live database and its archives with a snapshot.
+
+        The till must be closed. The current state is snapshotted first, so
+        a restore can itself be undone; returns that snapshot's name.
+        """
+        self.verify(name)
+        manifest = self.manifest(name)
+        undo = self._snapshot()
+        folder = os.path.join(self.folder, name)
+        live_folder = os.path.dirname(os.path.abspath(self.db.db_name))
+        with self.db.get_connection() as conn:
+            live_archives = [path for (path,) in conn.execute('SELECT path FROM archives')]
+        # Drop attached archives before their files are replaced
+        self.db.close()
+        
+        snapshot = sqlite3.connect(os.path.join(folder, manifest['database']))
+        try:
+            with self.db.get_connection() as conn:
+                # One step: the whole file is written under a single lock
+                snapshot.backup(conn)
+        finally:
+            snapshot.close()
+        restored = {entry['path'] for entry in manifest['archives'].values()}
+        for path in live_archives:
+            if path not in restored and os.path.exists(os.path.join(live_folder, path)):
+                os.remove(os.path.join(live_folder, path))
+        for path in restored:
+            shutil.copyfile(os.path.join(folder, path), os.path.join(live_folder, path))
+        return undo
+    
+    def start(self, interval):
+        """Take a snapshot every interval seconds on a background thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='backup', daemon=True)
+        self._thread.start()
+    
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                # Try again next time rather than lose the schedule
+                self.errors += 1
+                self.last_error = e
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
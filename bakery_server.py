@@ -0,0 +1,643 @@
+"""Serve one store database to every till in the shop.
+
+    python bakery_server.py --database bakery.db --host 0.0.0.0 --port 8765
+    python bakery_app.py --server=http://192.168.1.10:8765
+    python bakery_app.py --server=http://192.168.1.10:8765 --offline-first --terminal=2
+
+The server owns bakery.db and runs the same services as a standalone till,
+so invoice numbers and the catalog are shared by all tills. Tills connect
+as thin clients over HTTP: each thread keeps one connection open, and a
+list of calls can be sent in one request. An offline-first till instead
+sells from a database of its own and a SyncAgent keeps it in step with the
+store, so it goes on selling while the network is down.
+"""
+import argparse
+import base64
+import http.client
+import json
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from bakery_core import (CartLine, InvoiceSearch, DatabaseManager, InventoryService, SalesService,
+                         InvoicingService, ReportingService, SyncService, THUMBNAIL_SIZES)
+
+DEFAULT_PORT = 8765
+
+# Types that cross the wire as their __slots__ values
+WIRE_TYPES = {'CartLine': CartLine, 'InvoiceSearch': InvoiceSearch}
+# Errors the caller is meant to see, raised again on the client side
+WIRE_ERRORS = {'ValueError': ValueError, 'RuntimeError': RuntimeError}
+
+
+def to_wire(value):
+    """value as JSON-compatible data, tagging what JSON has no type for"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, list):
+        return [to_wire(item) for item in value]
+    if isinstance(value, tuple):
+        # Rows stay tuples, so they compare and unpack as they do locally
+        return {'$tuple': [to_wire(item) for item in value]}
+    if isinstance(value, dict):
+        # Thumbnails are keyed by (width, height)
+        return {'$map': [[to_wire(key), to_wire(item)] for key, item in value.items()]}
+    name = type(value).__name__
+    if WIRE_TYPES.get(name) is type(value):
+        return {'$' + name: [to_wire(getattr(value, slot)) for slot in value.__slots__]}
+    raise TypeError(f"Cannot send {name} to the store server")
+
+
+def _from_wire_object(obj):
+    if len(obj) == 1:
+        (tag, value), = obj.items()
+        if tag == '$bytes':
+            return base64.b64decode(value)
+        if tag == '$datetime':
+            return datetime.fromisoformat(value)
+        if tag == '$date':
+            return date.fromisoformat(value)
+        if tag == '$tuple':
+            return tuple(value)
+        if tag == '$map':
+            return {key: item for key, item in value}
+        if tag[1:] in WIRE_TYPES:
+            return WIRE_TYPES[tag[1:]](*value)
+    return obj
+
+
+def dumps(value):
+    return json.dumps(to_wire(value), separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    return json.loads(data, object_hook=_from_wire_object)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so a till sends every call down one connection
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, every
+    # reply would wait out the till's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_error(404)
+            return
+        if not self._authorized():
+            return
+        # Plain JSON, for monitoring scripts
+        self._reply(json.dumps(self.server.db.stats(), default=str).encode('utf-8'))
+
+    def do_POST(self):
+        if self.path != '/rpc':
+            self.send_error(404)
+            return
+        if not self._authorized():
+            return
+        try:
+            calls = loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['calls']
+        except (ValueError, KeyError, TypeError):
+            self.send_error(400)
+            return
+        self._reply(dumps({'results': self.server.dispatch(calls)}))
+
+    def _authorized(self):
+        """Whether the request carries the server's token; refuses it if not"""
+        if self.server.token and self.headers.get('X-Bakery-Token') != self.server.token:
+            self.send_error(403)
+            return False
+        return True
+
+    def _reply(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code='-', size='-'):
+        # Errors are still logged; one line per call would drown them
+        pass
+
+
+class BakeryServer(ThreadingHTTPServer):
+    """HTTP front for a DatabaseManager and the services built on it.
+
+    A thread serves each till connection and reuses one database connection
+    for all its requests. Only the operations listed in OPERATIONS can be
+    called.
+    """
+    daemon_threads = True
+    OPERATIONS = {
+        'db': ('get_image', 'get_thumbnail', 'store_image', 'store_thumbnail', 'stats'),
+        'inventory': ('list_items', 'get_item', 'add_item', 'update_item', 'delete_item', 'upsert_catalog'),
+        'sales': ('checkout',),
+        'invoicing': ('page', 'details'),
+        'reporting': ('daily', 'monthly', 'rebuild_rollup'),
+        'sync': ('push_sales', 'catalog_changes'),
+    }
+
+    def __init__(self, address, db, token=None):
+        super().__init__(address, _RequestHandler)
+        self.db = db
+        self.token = token
+        services = {
+            'db': db,
+            'inventory': InventoryService(db),
+            'sales': SalesService(db),
+            'invoicing': InvoicingService(db),
+            'reporting': ReportingService(db),
+            'sync': SyncService(db),
+        }
+        self.operations = {f'{prefix}.{name}': getattr(services[prefix], name)
+                           for prefix, names in self.OPERATIONS.items() for name in names}
+
+    def dispatch(self, calls):
+        """Run [operation, args, kwargs] calls in order on this thread's
+        connection, each in its own transaction; one result or error per
+        call"""
+        results = []
+        for operation, args, kwargs in calls:
+            fn = self.operations.get(operation)
+            try:
+                if fn is None:
+                    raise ValueError(f"Unknown operation {operation}")
+                # Each call is the outermost block on the connection, so one
+                # that fails mid-transaction is rolled back as it ends rather
+                # than left holding the write lock for the calls after it
+                with self.db.get_connection():
+                    results.append({'result': fn(*args, **kwargs)})
+            except Exception as e:
+                results.append({'error': [type(e).__name__, str(e)]})
+        return results
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            # The till disconnected and this thread ends with it
+            self.db.release_connection()
+
+
+class _Connection(http.client.HTTPConnection):
+    def connect(self):
+        super().connect()
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class BakeryClient:
+    """Calls a BakeryServer, one keep-alive connection per calling thread"""
+    TIMEOUT = 30
+
+    def __init__(self, url, token=None):
+        parts = urlsplit(url if '//' in url else 'http://' + url)
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or DEFAULT_PORT
+        self.token = token
+        self.requests = 0
+        self.calls = 0
+        # Keyed by thread id, like DatabaseManager's connections
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def connection(self):
+        thread_id = threading.get_ident()
+        conn = self._connections.get(thread_id)
+        if conn is None:
+            conn = _Connection(self.host, self.port, timeout=self.TIMEOUT)
+            with self._lock:
+                self._connections[thread_id] = conn
+        return conn
+
+    def call(self, operation, *args, **kwargs):
+        return self.batch([(operation, args, kwargs)])[0]
+
+    def batch(self, calls, raise_errors=True):
+        """Send (operation, args, kwargs) calls in one request. Results come
+        back in order; with raise_errors=False a failed call gives its
+        exception instead of raising it."""
+        body = dumps({'calls': [[operation, list(args), kwargs] for operation, args, kwargs in calls]})
+        headers = {'Content-Type': 'application/json'}
+        if self.token:
+            headers['X-Bakery-Token'] = self.token
+        conn = self.connection()
+        try:
+            conn.request('POST', '/rpc', body, headers)
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            # The next call reconnects. Nothing is retried: a checkout may
+            # have gone through before the connection dropped.
+            conn.close()
+            raise ConnectionError(f"Store server {self.url} unreachable: {e}") from e
+        if response.status != 200:
+            raise ConnectionError(f"Store server {self.url} refused the request: "
+                                  f"{response.status} {response.reason}")
+        self.requests += 1
+        self.calls += len(calls)
+        results = []
+        for outcome in loads(data)['results']:
+            if 'error' in outcome:
+                name, message = outcome['error']
+                error = WIRE_ERRORS.get(name, RuntimeError)(message)
+                if raise_errors:
+                    raise error
+                results.append(error)
+            else:
+                results.append(outcome['result'])
+        return results
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for conn in connections.values():
+            conn.close()
+
+
+class _RemoteConnection:
+    """Stands in for a sqlite3 connection where the till only needs to
+    interrupt a call. The server finishes it; the answer is dropped."""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def interrupt(self):
+        sock = self.conn.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class RemoteDatabase:
+    """The part of DatabaseManager the till uses directly, served by a
+    BakeryServer. Thumbnails are cached here: they are keyed by content
+    hash, so a cached one never goes stale."""
+    MAX_THUMBNAILS = 4096
+
+    def __init__(self, client):
+        self.client = client
+        self.db_name = client.url
+        # Statements run on the server; profile them there
+        self.profile = None
+        self._thumbnails = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def get_connection(self):
+        yield _RemoteConnection(self.client.connection())
+
+    def start_profiling(self, slow_ms=100, slow_log=None):
+        return None
+
+    def query_profile(self, top=20):
+        return None
+
+    def stats(self):
+        stats = self.client.call('db.stats')
+        stats.update(requests=self.client.requests, calls=self.client.calls)
+        return stats
+
+    def get_image(self, image_hash):
+        return self.client.call('db.get_image', image_hash)
+
+    def get_thumbnail(self, image_hash, size):
+        key = (image_hash, tuple(size))
+        with self._lock:
+            data = self._thumbnails.get(key)
+        if data is None:
+            data = self.client.call('db.get_thumbnail', image_hash, size)
+            if data is not None:
+                self._cache_thumbnail(key, data)
+        return data
+
+    def prefetch_thumbnails(self, image_hashes, sizes=THUMBNAIL_SIZES):
+        """Fetch every thumbnail not cached yet in one request"""
+        with self._lock:
+            missing = [(image_hash, size) for image_hash in dict.fromkeys(image_hashes) if image_hash
+                       for size in sizes if (image_hash, size) not in self._thumbnails]
+        if not missing:
+            return
+        results = self.client.batch([('db.get_thumbnail', key, {}) for key in missing], raise_errors=False)
+        for key, data in zip(missing, results):
+            if isinstance(data, bytes):
+                self._cache_thumbnail(key, data)
+
+    def _cache_thumbnail(self, key, data):
+        with self._lock:
+            self._thumbnails[key] = data
+            self._thumbnails.move_to_end(key)
+            while len(self._thumbnails) > self.MAX_THUMBNAILS:
+                self._thumbnails.popitem(last=False)
+
+    def store_image(self, data, thumbnails=None):
+        image_hash = self.client.call('db.store_image', data, thumbnails)
+        for size, thumbnail in (thumbnails or {}).items():
+            self._cache_thumbnail((image_hash, size), thumbnail)
+        return image_hash
+
+    def store_thumbnail(self, image_hash, size, data):
+        self.client.call('db.store_thumbnail', image_hash, size, data)
+        self._cache_thumbnail((image_hash, tuple(size)), data)
+
+    def close(self):
+        self.client.close()
+
+
+def _remote(operation, doc=None):
+    def call(self, *args, **kwargs):
+        return self.db.client.call(operation, *args, **kwargs)
+    call.__name__ = operation.split('.')[1]
+    call.__doc__ = doc
+    return call
+
+
+class RemoteInventory(InventoryService):
+    """InventoryService of a store server. Catalog files and images are
+    read and written on this machine; only the rows cross the wire."""
+    get_item = _remote('inventory.get_item')
+    add_item = _remote('inventory.add_item')
+    update_item = _remote('inventory.update_item')
+    delete_item = _remote('inventory.delete_item')
+    upsert_catalog = _remote('inventory.upsert_catalog')
+
+    def list_items(self):
+        """(id, name, price, image_hash) for the whole catalog, with the
+        thumbnails the grids show fetched in the same breath"""
+        items = self.db.client.call('inventory.list_items')
+        self.db.prefetch_thumbnails(item[3] for item in items)
+        return items
+
+
+class RemoteSales(SalesService):
+    checkout = _remote('sales.checkout')
+
+
+class RemoteInvoicing(InvoicingService):
+    page = _remote('invoicing.page', InvoicingService.page.__doc__)
+    details = _remote('invoicing.details')
+
+
+class RemoteReporting(ReportingService):
+    daily = _remote('reporting.daily', ReportingService.daily.__doc__)
+    monthly = _remote('reporting.monthly', ReportingService.monthly.__doc__)
+    rebuild_rollup = _remote('reporting.rebuild_rollup')
+
+
+def _remote_edit(operation):
+    def call(self, *args, **kwargs):
+        result = self.db.client.call(operation, *args, **kwargs)
+        self.sync.pull_catalog()
+        return result
+    call.__name__ = operation.split('.')[1]
+    return call
+
+
+class ReplicaInventory(RemoteInventory):
+    """Catalog of an offline-first till: read from the till's own copy and
+    edited on the store server, which the edit is pulled back from at once.
+    Only editing needs the server."""
+    add_item = _remote_edit('inventory.add_item')
+    update_item = _remote_edit('inventory.update_item')
+    delete_item = _remote_edit('inventory.delete_item')
+    upsert_catalog = _remote_edit('inventory.upsert_catalog')
+
+    def __init__(self, db, sync):
+        super().__init__(RemoteDatabase(sync.client))
+        self.local = InventoryService(db)
+        self.sync = sync
+
+    def list_items(self):
+        return self.local.list_items()
+
+    def get_item(self, item_id):
+        return self.local.get_item(item_id)
+
+
+class SyncAgent:
+    """Keeps an offline-first till's own database in step with the store.
+
+    The till sells from its own database and never waits for the network.
+    This agent's thread pushes the till's new invoices to the store server,
+    BATCH_INVOICES at a time as compressed JSON, then pulls the catalog
+    changes since the version it last saw. Both watermarks are kept in the
+    till's sync_state table, so sales made while the store was unreachable
+    go out once it is back, even after a restart. Invoices carry their uid:
+    resending a batch whose reply was lost writes nothing twice.
+    """
+    BATCH_INVOICES = 500
+    PUSHED = 'pushed_invoice_id'
+    CATALOG = 'catalog_version'
+
+    def __init__(self, db, client, interval=5):
+        self.db = db
+        self.client = client
+        self.interval = interval
+        self.online = None
+        self.pending = 0
+        self.oldest_pending = None
+        self.pushed = 0
+        self.rate = 0.0
+        self.compression = 0.0
+        self.last_sync = None
+        # Counts pulls that changed the catalog, so the till knows to redraw
+        self.catalog_updates = 0
+        self.errors = 0
+        self.last_error = None
+        self._pull_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _watermark(self, conn, name):
+        row = conn.execute('SELECT value FROM sync_state WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_watermark(self, cursor, name, value):
+        cursor.execute('INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)', (name, value))
+
+    def _count_pending(self, conn, pushed):
+        self.pending, self.oldest_pending = conn.execute(
+            'SELECT COUNT(*), MIN(created_at) FROM invoices WHERE id > ?', (pushed,)).fetchone()
+
+    def sync(self):
+        """Push every waiting sale, then pull catalog changes"""
+        while self.push_sales():
+            pass
+        self.pull_catalog()
+        self.last_sync = datetime.now()
+
+    def push_sales(self):
+        """Send the next batch of sales the store does not have yet; returns
+        how many were sent"""
+        with self.db.get_connection() as conn:
+            pushed = self._watermark(conn, self.PUSHED) or 0
+            self._count_pending(conn, pushed)
+            invoices = conn.execute('SELECT id, uid, number, created_at FROM invoices WHERE id > ? '
+                                    'ORDER BY id LIMIT ?', (pushed, self.BATCH_INVOICES)).fetchall()
+            if not invoices:
+                return 0
+            lines = {}
+            for invoice_id, item_id, quantity, total_price in conn.execute(
+                    'SELECT invoice_id, item_id, quantity, total_price FROM sales '
+                    'WHERE invoice_id BETWEEN ? AND ?', (invoices[0][0], invoices[-1][0])):
+                lines.setdefault(invoice_id, []).append((item_id, quantity, round(total_price * 100)))
+        entries = [{'uid': uid, 'number': number, 'created_at': created_at, 'lines': lines.get(invoice_id, [])}
+                   for invoice_id, uid, number, created_at in invoices]
+        data = json.dumps(entries, separators=(',', ':')).encode('utf-8')
+        batch = zlib.compress(data)
+        started = time.perf_counter()
+        self.client.call('sync.push_sales', batch)
+        elapsed = time.perf_counter() - started
+        
+        with self.db.get_connection() as conn:
+            self._set_watermark(conn.cursor(), self.PUSHED, invoices[-1][0])
+            conn.commit()
+            self._count_pending(conn, invoices[-1][0])
+        self.pushed += len(invoices)
+        self.rate = len(invoices) / max(elapsed, 1e-9)
+        self.compression = len(data) / len(batch)
+        return len(invoices)
+
+    def pull_catalog(self):
+        """Bring the till's catalog up to the store's; returns how many items
+        were added, changed or removed"""
+        with self._pull_lock:
+            with self.db.get_connection() as conn:
+                since = self._watermark(conn, self.CATALOG)
+            version, items, deleted = self.client.call('sync.catalog_changes', since)
+            if version == since:
+                return 0
+            
+            hashes = sorted({item[3] for item in items if item[3]})
+            with self.db.get_connection() as conn:
+                known = {row[0] for row in conn.execute(
+                    f"SELECT hash FROM images WHERE hash IN ({','.join('?' * len(hashes))})", hashes)}
+                if since is None:
+                    # The whole catalog: whatever else the till has is gone
+                    store_ids = {item[0] for item in items}
+                    deleted = [row[0] for row in conn.execute('SELECT id FROM items') if row[0] not in store_ids]
+            # New images with their thumbnails, all in one request
+            missing = [image_hash for image_hash in hashes if image_hash not in known]
+            calls = [call for image_hash in missing for call in
+                     [('db.get_image', (image_hash,), {})] +
+                     [('db.get_thumbnail', (image_hash, size), {}) for size in THUMBNAIL_SIZES]]
+            results = iter(self.client.batch(calls) if calls else ())
+            images = []
+            for image_hash in missing:
+                data = next(results)
+                thumbnails = {size: thumbnail for size in THUMBNAIL_SIZES
+                              for thumbnail in [next(results)] if thumbnail is not None}
+                if data is not None:
+                    images.append((data, thumbnails))
+            
+            with self.db.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('BEGIN IMMEDIATE')
+                for data, thumbnails in images:
+                    self.db._insert_image(cursor, data, thumbnails)
+                cursor.executemany('DELETE FROM items WHERE id = ?', [(item_id,) for item_id in deleted])
+                cursor.executemany('''
+                    INSERT INTO items (id, name, price, image_hash) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE
+                    SET name = excluded.name, price = excluded.price, image_hash = excluded.image_hash
+                ''', items)
+                self._set_watermark(cursor, self.CATALOG, version)
+                conn.commit()
+            if items or deleted:
+                self.catalog_updates += 1
+            return len(items) + len(deleted)
+
+    def status(self):
+        """Sync state for display; lag is the age in seconds of the oldest
+        sale the store does not have yet"""
+        oldest = self.oldest_pending
+        return {
+            'online': self.online,
+            'pending': self.pending,
+            'lag': (datetime.now() - datetime.fromisoformat(oldest)).total_seconds() if oldest else 0.0,
+            'last_sync': self.last_sync,
+            'pushed': self.pushed,
+            'rate': self.rate,
+            'compression': self.compression,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sync', daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """A sale was made or the catalog changed: sync now rather than at
+        the next interval"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync()
+                self.online = True
+            except ConnectionError as e:
+                self.online = False
+                self.last_error = e
+            except Exception as e:
+                # Try again next time rather than stop syncing
+                self.errors += 1
+                self.last_error = e
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='bakery.db')
+    parser.add_argument('--host', default='127.0.0.1', help='0.0.0.0 to serve the whole shop network')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--token', help='shared secret tills must send with --server-token')
+    parser.add_argument('--write-behind', action='store_true',
+                        help='journal checkouts and commit them in batches')
+    parser.add_argument('--profile', type=float, nargs='?', const=100, metavar='MS',
+                        help='log statements slower than MS to <database>.slow.log')
+    args = parser.parse_args(argv)
+
+    db = DatabaseManager(args.database, write_behind=args.write_behind)
+    if args.profile is not None:
+        db.start_profiling(args.profile, db.db_name + '.slow.log')
+    server = BakeryServer((args.host, args.port), db, args.token)
+    print(f"Serving {args.database} on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""Generate a synthetic bakery database and time the hot query paths.
+
+    python benchmark.py --items 300 --years 3 --invoices-per-day 200 --output bench.json
+
+Nothing is shown on screen; the timings go through DatabaseManager exactly
+as the till's do. Images and thumbnails are random bytes of realistic size,
+since only their storage and retrieval is measured.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from bakery_core import (DatabaseManager, CartLine, InvoiceSearch, BUTTON_THUMBNAIL, CELL_THUMBNAIL,
+                         ROLLUP_FROM_SALES_SQL)
+
+OPENING_HOUR = 6
+CLOSING_HOUR = 21
+
+
+def generate(path, items=200, years=2, invoices_per_day=150, invoice_lines=3,
+             image_kb=200, seed=1):
+    """Create a database at path with items, images and years of sales ending
+    today. Invoice sizes vary around invoice_lines; returns row counts."""
+    rng = random.Random(seed)
+    db = DatabaseManager(path)
+    with db.get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        catalog = []
+        for n in range(1, items + 1):
+            image_hash = db._insert_image(cursor, rng.randbytes(image_kb * 1024), {
+                CELL_THUMBNAIL: rng.randbytes(3 * 1024),
+                BUTTON_THUMBNAIL: rng.randbytes(12 * 1024),
+            })
+            price = rng.randrange(50, 2500, 25)
+            cursor.execute('INSERT INTO items (name, price, image_hash) VALUES (?, ?, ?)',
+                          (f'Item {n:04d}', price / 100, image_hash))
+            catalog.append((cursor.lastrowid, price))
+        conn.commit()
+
+        invoice_count = sale_count = 0
+        today = date.today()
+        day = today - timedelta(days=365 * years)
+        while day <= today:
+            cursor.execute('BEGIN IMMEDIATE')
+            opening = datetime.combine(day, datetime.min.time()) + timedelta(hours=OPENING_HOUR)
+            seconds_open = (CLOSING_HOUR - OPENING_HOUR) * 3600
+            count = max(1, int(rng.gauss(invoices_per_day, invoices_per_day / 5)))
+            times = sorted(opening + timedelta(seconds=rng.randrange(seconds_open)) for _ in range(count))
+            for number, created_at in enumerate(times, start=1):
+                size = min(len(catalog), max(1, int(rng.expovariate(1 / invoice_lines)) + 1))
+                lines = [(item_id, rng.randint(1, 5), price)
+                         for item_id, price in rng.sample(catalog, size)]
+                cursor.execute('''
+                    INSERT INTO invoices (number, created_at, item_count, total_quantity, total)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (number, created_at, size, sum(q for _, q, _ in lines),
+                      sum(q * p for _, q, p in lines) / 100))
+                invoice_id = cursor.lastrowid
+                cursor.executemany('''
+                    INSERT INTO sales (item_id, quantity, total_price, sale_date, invoice_id)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(item_id, q, q * p / 100, created_at, invoice_id) for item_id, q, p in lines])
+                sale_count += size
+            cursor.execute('INSERT OR REPLACE INTO daily_invoice_count (date, count) VALUES (?, ?)',
+                          (day.isoformat(), count))
+            invoice_count += count
+            conn.commit()
+            day += timedelta(days=1)
+
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('INSERT INTO sales_rollup (day, item_id, quantity, revenue_cents) ' + ROLLUP_FROM_SALES_SQL)
+        conn.commit()
+    db.close()
+    return {'items': items, 'invoices': invoice_count, 'sales': sale_count}
+
+
+def measure(fn, repeat):
+    """Call fn repeat times; latency summary in milliseconds"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'count': repeat,
+        'mean_ms': sum(samples) / repeat,
+        'p50_ms': samples[repeat // 2],
+        'p95_ms': samples[min(repeat - 1, int(repeat * 0.95))],
+        'max_ms': samples[-1],
+    }
+
+
+def run(path, repeat=50, seed=1, profile=False):
+    """Time every hot path against the database at path; with profile the
+    per-statement breakdown is returned as well"""
+    rng = random.Random(seed)
+    db = DatabaseManager(path)
+    if profile:
+        db.start_profiling()
+    items = db.list_items()
+    with db.get_connection() as conn:
+        invoice_ids = [row[0] for row in conn.execute('SELECT id FROM invoices')]
+        days = [row[0] for row in conn.execute('SELECT DISTINCT day FROM sales_rollup')]
+
+    def checkout(manager):
+        lines = [CartLine(item[0], item[1], round(item[2] * 100), rng.randint(1, 5))
+                 for item in rng.sample(items, min(len(items), 3))]
+        return lambda: manager.record_sale(lines)
+
+    def allocate_number():
+        with db.get_connection() as conn:
+            db.invoice_numbers.reserve(conn.cursor(), date.today().isoformat())
+            conn.commit()
+
+    def history_page():
+        db.invoice_page(datetime.min, None, 200)
+
+    def history_by_total():
+        db.invoice_page(datetime.min, None, 200, 'total', rng.random() < 0.5)
+
+    def search_last_month():
+        end = date.today().replace(day=1) - timedelta(days=1)
+        db.invoice_page(None, None, 200, search=InvoiceSearch(start=end.replace(day=1), end=end,
+                                                              item=rng.choice(items)[1]))
+
+    def invoice_detail():
+        db.invoice_details(rng.choice(invoice_ids))
+
+    def daily_report():
+        day = date.fromisoformat(rng.choice(days))
+        db.sales_summary(day, day + timedelta(days=1))
+
+    def monthly_report():
+        first = date.fromisoformat(rng.choice(days)).replace(day=1)
+        db.sales_summary(first, (first + timedelta(days=32)).replace(day=1))
+
+    def item_grid():
+        for item in db.list_items():
+            db.get_thumbnail(item[3], BUTTON_THUMBNAIL)
+
+    results = {
+        'checkout': measure(checkout(db), repeat),
+        'invoice_number': measure(allocate_number, repeat),
+        'history_page': measure(history_page, repeat),
+        'history_by_total': measure(history_by_total, repeat),
+        'search_last_month': measure(search_last_month, repeat),
+        'invoice_detail': measure(invoice_detail, repeat),
+        'daily_report': measure(daily_report, repeat),
+        'monthly_report': measure(monthly_report, repeat),
+        'item_grid': measure(item_grid, repeat),
+    }
+    statements = db.query_profile()
+    db.close()
+
+    # The journal stays in the work folder, which is removed afterwards
+    write_behind = DatabaseManager(path, write_behind=True, sales_journal=path + '.journal')
+    results['checkout_write_behind'] = measure(checkout(write_behind), repeat)
+    write_behind.close()
+    return results, statements
+
+
+def describe():
+    """Where the numbers came from"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'commit': commit or None,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=200)
+    parser.add_argument('--years', type=int, default=2)
+    parser.add_argument('--invoices-per-day', type=int, default=150)
+    parser.add_argument('--invoice-lines', type=int, default=3, help='average lines per invoice')
+    parser.add_argument('--image-kb', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database', help='benchmark this file instead of generating one (it is written to)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated database')
+    parser.add_argument('--profile', action='store_true', help='include the busiest statements and slow queries')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = describe()
+    workdir = None
+    if args.database:
+        path = args.database
+    else:
+        workdir = tempfile.mkdtemp(prefix='bakery-bench-')
+        path = os.path.join(workdir, 'bakery.db')
+        params = {key: getattr(args, key) for key in
+                  ('items', 'years', 'invoices_per_day', 'invoice_lines', 'image_kb', 'seed')}
+        started = time.perf_counter()
+        report['dataset'] = dict(params, **generate(path, **params))
+        report['generate_s'] = time.perf_counter() - started
+    report['database_bytes'] = os.path.getsize(path)
+    report['results'], statements = run(path, args.repeat, args.seed, args.profile)
+    if statements is not None:
+        report['query_profile'] = statements
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if workdir and not args.keep:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    elif workdir:
+        print(f"Database kept at {path}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
+import os
 import sqlite3
 import sys
 from PyQt6.QtWidgets import QApplication, QMessageBox, QWidget, QVBoxLayout, QPushButton, QLabel
 from PyQt6.QtCore import Qt
+from bakery_core import DatabaseManager, default_journal_path
 
 class DatabaseResetter(QWidget):
     def __init__(self):
@@ -65,41 +67,31 @@ class DatabaseResetter(QWidget):
                 cursor = conn.cursor()
                 
                 # Drop all tables
-                cursor.execute('DROP TABLE IF EXISTS sales')
-                cursor.execute('DROP TABLE IF EXISTS items')
-                cursor.execute('DROP TABLE IF EXISTS daily_invoice_count')
-                
-                # Recreate tables
-                cursor.execute('''
-                    CREATE TABLE items (
-                        id INTEGER PRIMARY KEY,
-                        name TEXT NOT NULL,
-                        price REAL NOT NULL,
-                        image_data TEXT
-                    )
-                ''')
-                
-                cursor.execute('''
-                    CREATE TABLE sales (
-                        id INTEGER PRIMARY KEY,
-                        item_id INTEGER,
-                        quantity INTEGER,
-                        total_price REAL,
-                        sale_date DATETIME,
-                        FOREIGN KEY (item_id) REFERENCES items (id)
-                    )
-                ''')
-                
-                cursor.execute('''
-                    CREATE TABLE daily_invoice_count (
-                        date TEXT PRIMARY KEY,
-                        count INTEGER DEFAULT 0
-                    )
-                ''')
+                tables = cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+                ).fetchall()
+                archives = []
+                if ('archives',) in tables:
+                    archives = [path for (path,) in cursor.execute('SELECT path FROM archives')]
+                for (table,) in tables:
+                    cursor.execute(f'DROP TABLE IF EXISTS "{table}"')
+                cursor.execute('PRAGMA user_version = 0')
                 
                 conn.commit()
                 conn.close()
                 
+                # Unwritten sales from a write-behind till belong to the old data
+                journal = default_journal_path('bakery.db')
+                if os.path.exists(journal):
+                    os.remove(journal)
+                # So do the archived years
+                for path in archives:
+                    if os.path.exists(path):
+                        os.remove(path)
+                
+                # Recreate tables
+                DatabaseManager('bakery.db').close()
+                
                 self.status_label.setText("Database has been reset successfully!")
                 self.status_label.setStyleSheet("color: #2e7d32; font-size: 12px;")
                 